@@ -2,20 +2,14 @@
 """
 
 
-# Future imports to support fancy print() on Python 2.x
-from __future__ import print_function
-
 # System imports
 import os
+import sys
 import threading
-from collections import defaultdict
-from functools import wraps
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
 from time import sleep
-from sys import stdout
-
-# Six imports
-from six import iteritems
-from six.moves import queue
 
 # owls-cache imports
 # HACK: We use a private function, but owls-parallel is intrinsically linked to
@@ -32,28 +26,264 @@ __version__ = '0.0.1'
 _output_is_tty = (os.fstat(0) == os.fstat(1))
 
 
+# Utility function to create a function which writes progress output.  When
+# standard output is the process' original standard output and is backed by a
+# file descriptor, progress is written with a single unbuffered write call,
+# which avoids separate formatting and flushing and can't be interleaved
+# mid-line with other output.  Otherwise (e.g. in an IPython notebook, where
+# the replacement stream may still report the kernel's original descriptor)
+# progress is written to the stream.
+def _progress_writer():
+    # Flush any buffered output so that it appears before progress
+    stream = sys.stdout
+    stream.flush()
+
+    # Check if the stream is the original one and has a file descriptor
+    fd = None
+    if stream is sys.__stdout__:
+        try:
+            fd = stream.fileno()
+        except (AttributeError, ValueError, OSError):
+            pass
+
+    # Create the writer
+    if fd is not None:
+        def write(text):
+            os.write(fd, text.encode('utf-8'))
+    else:
+        def write(text):
+            stream.write(text)
+            stream.flush()
+    return write
+
+
+# The initial interval, in seconds, between progress queries when monitoring
+# jobs.  The interval is doubled (up to the environment's monitor interval)
+# each time a query shows no progress, and reset whenever progress is made.
+_INITIAL_MONITOR_INTERVAL = 0.1
+
+
 # Create a thread-local variable to track whether or not the current thread is
-# in capture mode
-_thread_local = threading.local()
+# in capture mode.  The parallelizer attribute is initialized for each thread
+# so that it can be read directly without a getattr default.
+class _ThreadLocal(threading.local):
+    def __init__(self):
+        self.owls_parallelizer = None
+_thread_local = _ThreadLocal()
 
 
-# Utility function to get the current parallelizer
-def _get_parallelizer():
-    return getattr(_thread_local, 'owls_parallelizer', None)
+# Track the number of threads which are currently in capture mode, allowing
+# @parallelized wrappers to skip the thread-local lookup entirely in the common
+# case where no thread is capturing
+_capture_active = 0
+_capture_active_lock = threading.Lock()
 
 
 # Utility function to set the current parallelizer
 def _set_parallelizer(parallelizer):
+    global _capture_active
+
+    # Update the active capture count if this thread is entering or leaving
+    # capture mode
+    previous = _thread_local.owls_parallelizer
+    if (previous is None) != (parallelizer is None):
+        with _capture_active_lock:
+            _capture_active += 1 if parallelizer is not None else -1
+
+    # Set the parallelizer for this thread
     _thread_local.owls_parallelizer = parallelizer
 
 
+# The types of mapper return values which can be used directly as grouping keys
+_HASHABLE = frozenset((int, str, bytes, tuple, frozenset))
+
+
+# Utility function to recursively convert unhashable containers (lists and
+# dictionaries) returned by mappers into hashable equivalents
+def _freeze(value):
+    if isinstance(value, dict):
+        return frozenset((k, _freeze(v)) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    elif isinstance(value, set):
+        return frozenset(_freeze(v) for v in value)
+    return value
+
+
+# Utility function to compute a canonical string representation of a grouping
+# key.  Unlike repr, this is independent of set iteration order (which can vary
+# between processes due to hash randomization).
+def _canonical_repr(value):
+    if isinstance(value, (set, frozenset)):
+        return '{{{0}}}'.format(', '.join(sorted(_canonical_repr(v)
+                                                 for v in value)))
+    elif isinstance(value, tuple):
+        return '({0},)'.format(', '.join(_canonical_repr(v) for v in value))
+    return repr(value)
+
+
+# Utility function to compute a digest of a grouping key which, unlike hash, is
+# stable across processes and can thus be used to order jobs reproducibly
+def _stable_key(value):
+    return sha1(_canonical_repr(value).encode('utf-8')).digest()[:8]
+
+
+# Utility function to compute the qualified name of a function (which is
+# stable across processes, unlike its id), used to order jobs
+def _function_name(function):
+    return '{0}.{1}'.format(getattr(function, '__module__', ''),
+                            getattr(function, '__name__', ''))
+
+
+# The frozen keyword arguments used when deduplicating calls which have no
+# keyword arguments
+_NO_KWARGS = frozenset()
+
+
+class _Bucket(object):
+    """Records the calls captured for a single (key, batcher, function)
+    combination.
+
+    Arguments and keyword arguments are stored in parallel lists, avoiding the
+    allocation of an (args, kwargs) tuple for each captured call.  Iterating
+    over a bucket yields (args, kwargs) tuples, so buckets can be passed
+    directly to batchers.
+
+    Buckets also track the calls they have recorded so that repeated identical
+    calls are only recorded once.  This deduplication is best-effort: calls
+    with unhashable arguments (e.g. lists or NumPy arrays) are always
+    recorded, and calls whose arguments compare equal (e.g. 1 and 1.0) are
+    considered identical.  The set of seen calls is not pickled.
+    """
+
+    __slots__ = ('args', 'kwargs', 'seen')
+
+    def __init__(self):
+        """Creates a new, empty bucket.
+        """
+        self.args = []
+        self.kwargs = []
+        self.seen = set()
+
+    def record(self, args, kwargs):
+        """Records a call, unless an identical call has already been recorded.
+
+        Args:
+            args: The arguments to the call
+            kwargs: The keyword arguments to the call
+        """
+        # Identify the call, skipping deduplication if it isn't hashable, since
+        # identifying it by another means (e.g. its pickled form) would cost
+        # more on every capture than recording the occasional duplicate
+        try:
+            call = (args,
+                    frozenset(kwargs.items()) if kwargs else _NO_KWARGS)
+            hash(call)
+        except TypeError:
+            call = None
+
+        # Check if we've already seen this call
+        if call is not None:
+            if call in self.seen:
+                return
+            self.seen.add(call)
+
+        # Record the call
+        self.args.append(args)
+        self.kwargs.append(kwargs)
+
+    def slice(self, start, stop):
+        """Creates a new bucket containing a subset of this bucket's calls.
+
+        Args:
+            start: The index of the first call to include
+            stop: The index after the last call to include
+
+        Returns:
+            A new bucket (without deduplication information).
+        """
+        result = _Bucket()
+        result.args = self.args[start:stop]
+        result.kwargs = self.kwargs[start:stop]
+        return result
+
+    def __len__(self):
+        return len(self.args)
+
+    def __iter__(self):
+        return zip(self.args, self.kwargs)
+
+    def __getstate__(self):
+        return (self.args, self.kwargs)
+
+    def __setstate__(self, state):
+        self.args, self.kwargs = state
+        self.seen = set()
+
+
+# The minimum number of calls to allow in a single job when splitting
+# oversized job specifications across workers
+_MINIMUM_CHUNK_SIZE = 32
+
+
+class _SplitKey(object):
+    """The key of one part of a job specification which has been split into
+    multiple jobs.
+
+    Split keys compare by identity, so they can never collide with the keys
+    returned by mappers (or with each other).
+    """
+
+    __slots__ = ('key', 'index')
+
+    def __init__(self, key, index):
+        """Creates a new split key.
+
+        Args:
+            key: The key of the job specification which was split
+            index: The index of the part
+        """
+        self.key = key
+        self.index = index
+
+
+# Utility function to split a job specification into consecutive chunks of at
+# most the specified number of calls each
+def _split_spec(spec, size):
+    # Create the result
+    result = []
+
+    # Pack calls into chunks in order
+    chunk = OrderedDict()
+    count = 0
+    for batcher, calls in spec.items():
+        for function, bucket in calls.items():
+            start = 0
+            while start < len(bucket):
+                stop = min(start + size - count, len(bucket))
+                chunk.setdefault(batcher, OrderedDict())[function] = \
+                    bucket.slice(start, stop)
+                count += stop - start
+                start = stop
+                if count == size:
+                    result.append(chunk)
+                    chunk = OrderedDict()
+                    count = 0
+    if count > 0:
+        result.append(chunk)
+
+    # All done
+    return result
+
+
 # The default batch executer
 def _batcher(function, args_kwargs):
     for args, kwargs in args_kwargs:
         function(*args, **kwargs)
 
 
-def parallelized(mocker, mapper, batcher = _batcher):
+def parallelized(mocker = None, mapper = None, batcher = _batcher,
+                 fused = None):
     """Decorator to add parallelization functionality to a callable.
 
     The underlying function, or some function further down the call stack, must
@@ -66,6 +296,13 @@ def parallelized(mocker, mapper, batcher = _batcher):
     Finally, the underlying function must also be importable by name on
     engines.
 
+    If the underlying function exposes a `_cache_key` attribute (a function
+    mapping its arguments to the key under which its result is stored in the
+    persistent cache), and the persistent cache provides a non-blocking
+    `peek(key)` method returning a (found, value) tuple, then calls whose
+    results are already cached are not captured during capture mode, and the
+    cached value is returned immediately instead of a dummy value.
+
     Args:
         mocker: A function which takes the same arguments as the underlying
             function and returns a dummy default value which has the same
@@ -73,39 +310,72 @@ def parallelized(mocker, mapper, batcher = _batcher):
             quickly and returned whilst in capture mode
         mapper: A function which accepts the same arguments as the underlying
             function and maps them to a hashable tuple of values, which will
-            then be hashed to act as a grouping key for parallel jobs.  This
-            can be useful to, e.g., group jobs in a manner conducive to
-            caching.  If the argument types to the underlying function are not
-            hashable (e.g. they are lists or dictionaries), then this function
-            provides a mechanism by which to convert them to hashable types
-            (e.g. tuples).
-        batcher: A function which can be called with a function and a list of
-            (args, kwargs) tuples and call the function with each of the
-            arguments.  Defaults to a naive implementation which simply
+            act directly as a grouping key for parallel jobs.  This can be
+            useful to, e.g., group jobs in a manner conducive to caching.  If
+            the argument types to the underlying function are not hashable
+            (e.g. they are lists or dictionaries), then this function provides
+            a mechanism by which to convert them to hashable types (e.g.
+            tuples).  As a convenience, list, dictionary, and set return
+            values are converted to hashable equivalents automatically, but
+            doing so is slower than returning a hashable value directly.
+        batcher: A function which can be called with a function and an
+            iterable of (args, kwargs) tuples and call the function with each
+            of the arguments.  Defaults to a naive implementation which simply
             iterates through args/kwargs and calls the function, but users can
             replace this with a function which calls the underlying function in
             a more optimal manner (e.g. one conducive to caching).  This
             function must be pickleable (i.e. importable by name).
+        fused: A function which accepts the same arguments as the underlying
+            function and returns a (key, default) tuple, where key and default
+            are equivalent to the return values of mapper and mocker,
+            respectively.  This can be provided instead of mocker and mapper
+            when the two would otherwise duplicate expensive work (e.g.
+            introspection of arguments).  If provided, mocker and mapper are
+            ignored.
 
     Returns:
         A version of the function which supports parallelization using a job
         capture paradigm.
     """
+    # Validate arguments
+    if fused is None and (mocker is None or mapper is None):
+        raise ValueError('mocker and mapper or fused must be provided')
+
     # Create the decorator
     def decorator(f):
+        # Check if the function can tell us where its results are cached
+        cache_key = getattr(f, '_cache_key', None)
+
         # Create the wrapper function
-        @wraps(f)
         def wrapper(*args, **kwargs):
+            # If no thread is in capture mode, then we're done
+            if not _capture_active:
+                return f(*args, **kwargs)
+
             # Grab the current parallelizer
-            parallelizer = _get_parallelizer()
+            parallelizer = _thread_local.owls_parallelizer
 
             # If we're not in capture mode, then we're done
             if parallelizer is None:
                 return f(*args, **kwargs)
 
-            # Otherwise, we are in capture mode, so we need to compute the key
-            # by which to organize this job
-            key = hash(mapper(*args, **kwargs))
+            # Otherwise, we are in capture mode.  If the result of this call
+            # is already cached, then there's no need to capture it.
+            if cache_key is not None and parallelizer._peek is not None:
+                found, value = parallelizer._peek(cache_key(*args, **kwargs))
+                if found:
+                    return value
+
+            # Otherwise we need to compute the key by which to organize this
+            # job.  We use the mapped value directly (rather than its hash) so
+            # that distinct keys can never collide, only falling back to
+            # freezing for unhashable container types.
+            if fused is not None:
+                key, default = fused(*args, **kwargs)
+            else:
+                key = mapper(*args, **kwargs)
+            if type(key) not in _HASHABLE:
+                key = _freeze(key)
 
             # Register the job with the parallelizer
             # NOTE: We register the *wrapper* function, because it is what will
@@ -113,8 +383,20 @@ def parallelized(mocker, mapper, batcher = _batcher):
             parallelizer._record(key, batcher, wrapper, args, kwargs)
 
             # Return a dummy value
+            if fused is not None:
+                return default
             return mocker(*args, **kwargs)
 
+        # Give the wrapper the identity of the underlying function, which is
+        # what allows it to be pickled (and imported) by name on engines.  We
+        # deliberately don't use functools.wraps, since the remaining
+        # attributes it copies (__dict__ and __wrapped__) are unnecessary and
+        # the latter bloats introspection of the wrapper.
+        wrapper.__module__ = f.__module__
+        wrapper.__name__ = f.__name__
+        wrapper.__qualname__ = getattr(f, '__qualname__', f.__name__)
+        wrapper.__doc__ = f.__doc__
+
         # Return the wrapper
         return wrapper
 
@@ -122,22 +404,10 @@ def parallelized(mocker, mapper, batcher = _batcher):
     return decorator
 
 
-# Convenience function to recursively convert defaultdict objects to normal
-# dictionary objects so they can be pickled (if we use lambdas in the
-# constructor of the defaultdict, they won't pickle)
-def _dict_convert(dictionary):
-    # Create the result
-    result = {}
-
-    # Add items
-    for k, v in iteritems(dictionary):
-        if isinstance(v, defaultdict):
-            result[k] = _dict_convert(v)
-        else:
-            result[k] = v
-
-    # All done
-    return result
+# The run states of a ParallelizedEnvironment
+_STATE_FRESH = 0
+_STATE_CAPTURING = 1
+_STATE_COMPUTED = 2
 
 
 class ParallelizedEnvironment(object):
@@ -145,43 +415,43 @@ class ParallelizedEnvironment(object):
     directive are captured when called and then executed on a given backend.
     """
 
-    def __init__(self, backend, monitor_interval = 5):
+    def __init__(self, backend, monitor_interval = 5, submit_concurrency = 32):
         """Creates a new instance of the ParallelizedEnvironment class.
 
         Args:
             backend: The backend to use for parallelization (None for no
                 parallelization)
-            monitor_interval: How often to query/print progress, in seconds
-                (defaults to 5)
+            monitor_interval: The maximum interval between progress queries,
+                in seconds (defaults to 5).  Queries start out more frequent
+                and back off exponentially to this interval while no progress
+                is being made.
+            submit_concurrency: The maximum number of concurrent calls to
+                make to the backend's start method, if the backend supports
+                concurrent submission (defaults to 32)
         """
-        # Create variables to track run state
-        self._captured = False
-        self._computed = False
+        # Track run state
+        self._state = _STATE_FRESH
 
-        # Create the list of register jobs.  Structure is:
+        # Create the map of registered jobs.  Structure is:
         # {
-        #     {
-        #         key: {
-        #             batcher: {
-        #                 function: [
-        #                     (args1, kwargs1),
-        #                     ...
-        #                     (argsN, kwargsN),
-        #                 ],
-        #                 ...
-        #             },
-        #             ...
-        #         },
+        #     (key, batcher, function): _Bucket([
+        #         (args1, kwargs1),
         #         ...
-        #     }
+        #         (argsN, kwargsN),
+        #     ]),
+        #     ...
         # }
-        self._jobs = defaultdict(
-            lambda: defaultdict(lambda: defaultdict(list))
-        )
+        self._jobs = {}
 
-        # Store the backend and progress interval
+        # The persistent cache in use and its non-blocking lookup method (if
+        # any), which are recorded when capturing begins
+        self._cache = None
+        self._peek = None
+
+        # Store the backend, progress interval, and submission concurrency
         self._backend = backend
         self._monitor_interval = monitor_interval
+        self._submit_concurrency = submit_concurrency
 
     def _record(self, key, batcher, function, args, kwargs):
         """Adds a new job to be computed on the parallel backend.
@@ -194,7 +464,11 @@ class ParallelizedEnvironment(object):
             args: The arguments to the function
             kwargs: The keyword arguments to the function
         """
-        self._jobs[key][batcher][function].append((args, kwargs))
+        job = (key, batcher, function)
+        bucket = self._jobs.get(job)
+        if bucket is None:
+            bucket = self._jobs[job] = _Bucket()
+        bucket.record(args, kwargs)
 
     def _compute(self, progress):
         """Runs computation and blocks until completion, optionally printing
@@ -203,36 +477,94 @@ class ParallelizedEnvironment(object):
         Args:
             progress: Whether or not to print progress information
         """
-        # Grab current persistent cache and validate it
-        cache = _get_cache()
-        if cache is None:
-            raise RuntimeError('not inside a cached context')
-
-        # Create a queue on which backends can notify us of new results
-        notification_queue = queue.Queue()
+        # Create an event by which backends can notify us of new results, so
+        # that any number of notifications which arrive between checks cause
+        # only a single wakeup
+        notified = threading.Event()
 
         # Create a monitoring function, which waits for notifications, but also
-        # allows for regular polling
-        def monitor():
-            try:
-                notification_queue.get(timeout = self._monitor_interval)
-            except queue.Empty:
-                pass
+        # allows for regular polling.  The event is cleared before jobs are
+        # checked, so a notification arriving during the check isn't lost.
+        def monitor(interval):
+            notified.wait(interval)
+            notified.clear()
             return True
 
         # Create a notification callback
         def callback():
-            return notification_queue.put(None)
-
-        # Start jobs
-        all_jobs = self._backend.start(cache,
-                                       _dict_convert(self._jobs),
-                                       callback)
+            notified.set()
+
+        # Convert the recorded jobs to the nested job specification structure
+        # expected by backends.  Jobs are ordered by batcher and function
+        # name, and then by a stable digest of their keys, so that jobs using
+        # the same functions are dispatched contiguously (which is friendlier
+        # to any per-function state on workers) and in the same order in every
+        # process.
+        ordered = sorted(
+            self._jobs.items(),
+            key = lambda j: (_function_name(j[0][1]),
+                             _function_name(j[0][2]),
+                             _stable_key(j[0][0]))
+        )
+        # The specifications are plain (ordered) dictionaries which can be
+        # passed to backends and pickled as-is, and the number of calls in each
+        # is tallied as it is built, so no further walks over the nested
+        # structure are required.
+        job_specs = OrderedDict()
+        call_counts = {}
+        for (key, batcher, function), args_kwargs in ordered:
+            spec = job_specs.get(key)
+            if spec is None:
+                spec = job_specs[key] = OrderedDict()
+                call_counts[key] = 0
+            calls = spec.get(batcher)
+            if calls is None:
+                calls = spec[batcher] = OrderedDict()
+            calls[function] = args_kwargs
+            call_counts[key] += len(args_kwargs)
+
+        # If the backend knows how many workers it has, split job
+        # specifications which are large relative to the total workload into
+        # multiple jobs, so that a single hot key can't leave one worker as a
+        # straggler while the others sit idle
+        worker_count = getattr(self._backend, 'worker_count', None)
+        if worker_count:
+            total_calls = sum(call_counts.values())
+            chunk_size = max(_MINIMUM_CHUNK_SIZE,
+                             total_calls // (worker_count * 4))
+            split_specs = OrderedDict()
+            for key, spec in job_specs.items():
+                if call_counts[key] <= chunk_size:
+                    split_specs[key] = spec
+                    continue
+                for i, chunk in enumerate(_split_spec(spec, chunk_size)):
+                    split_specs[_SplitKey(key, i)] = chunk
+            job_specs = split_specs
+
+        # Start jobs.  If the backend supports concurrent calls to start, then
+        # split the job specifications into contiguous groups and start them
+        # concurrently, so that any per-job submission latency on the backend
+        # overlaps rather than accumulates.
+        def start(specs):
+            return self._backend.start(self._cache, specs, callback)
+        concurrency = min(self._submit_concurrency, len(job_specs))
+        if getattr(self._backend, 'parallel_submit', False) \
+                and concurrency > 1:
+            items = list(job_specs.items())
+            size = (len(items) + concurrency - 1) // concurrency
+            groups = [OrderedDict(items[i:i + size])
+                      for i
+                      in range(0, len(items), size)]
+            with ThreadPoolExecutor(max_workers = len(groups)) as executor:
+                job_collections = list(executor.map(start, groups))
+        else:
+            job_collections = [start(job_specs)]
 
         # Compute printing parameters
+        total = sum(len(c) for c in job_collections)
         n_blocks = 50
         percentage_width = 3
-        job_count_width = len(str(len(all_jobs)))
+        job_count_width = len(str(total))
         format_string = \
             '{{}}[{{:<{0}}}] {{:>{1}.0f}}% ({{:>{2}}}/{{:>{2}}})'.format(
                 n_blocks,
@@ -240,50 +572,80 @@ class ParallelizedEnvironment(object):
                 job_count_width
             )
 
-        # Monitor jobs
-        remaining_jobs = all_jobs
+        # Monitor jobs.  The number of completed jobs at the time of the last
+        # progress print is tracked separately so that we only format and
+        # write progress when it has changed.
+        if progress:
+            write_progress = _progress_writer()
+        completed_since = getattr(self._backend, 'completed_since', None)
+        if completed_since is not None:
+            remaining_jobs = set(j for c in job_collections for j in c)
+            completion_token = None
+        else:
+            remaining_jobs = job_collections
         previous_completed = 0
-        initial = True
-        while monitor():
-            # Grab the unfinished jobs
-            remaining_jobs = self._backend.prune(remaining_jobs)
+        printed_completed = None
+        initial_interval = min(_INITIAL_MONITOR_INTERVAL,
+                               self._monitor_interval)
+        interval = initial_interval
+        while monitor(interval):
+            # Grab the unfinished jobs, preferring incremental completion
+            # queries if the backend supports them
+            if completed_since is not None:
+                completed_jobs, completion_token = \
+                    completed_since(completion_token)
+                remaining_jobs.difference_update(completed_jobs)
+                remaining = len(remaining_jobs)
+            else:
+                remaining_jobs = [self._backend.prune(c)
+                                  for c
+                                  in remaining_jobs]
+                remaining = sum(len(c) for c in remaining_jobs)
 
             # Compute progress
-            total = len(all_jobs)
-            completed = total - len(remaining_jobs)
+            completed = total - remaining
 
             # Print the percentage if necessary
-            if progress and ((completed != previous_completed) or initial):
+            if progress and completed != printed_completed:
                 # Compute display information
-                fraction_completed = float(completed) / total
+                fraction_completed = \
+                    (float(completed) / total) if total > 0 else 1.0
                 filled_blocks = int(fraction_completed * n_blocks)
 
-                # Print differently based on the output device
-                print(
-                    format_string.format(
-                        '\r' if _output_is_tty else '',
-                        '#' * filled_blocks,
-                        fraction_completed * 100,
-                        completed,
-                        total),
-                    end = '' if _output_is_tty else os.linesep
+                # Print differently based on the output device, finishing the
+                # line if we're done
+                line = format_string.format(
+                    '\r' if _output_is_tty else '',
+                    '#' * filled_blocks,
+                    fraction_completed * 100,
+                    completed,
+                    total
                 )
-                stdout.flush()
+                if not _output_is_tty:
+                    line += os.linesep
+                if completed == total:
+                    line += os.linesep
+                write_progress(line)
+                printed_completed = completed
+
+            # Poll eagerly while jobs are completing, backing off while they
+            # aren't
+            if completed != previous_completed:
+                interval = initial_interval
+            else:
+                interval = min(interval * 2, self._monitor_interval)
 
             # Update state
             previous_completed = completed
-            initial = False
 
             # If we're done, leave this loop
             if completed == total:
-                if progress:
-                    print('')
                 break
 
     def capturing(self):
         """Returns True if the environment is in capture mode, False otherwise.
         """
-        return self._captured and not self._computed
+        return self._state == _STATE_CAPTURING
 
     def run(self, progress = True):
         """Manages execution in a parallelized environment, optionally printing
@@ -320,29 +682,38 @@ class ParallelizedEnvironment(object):
             True or False depending on run state.
         """
         # Handle based on state
-        if self._backend is None and not (self._captured or self._computed):
-            # If we have no backend, then mark ourselves as completed the first
-            # time through, since we won't be doing any parallelization
-            if progress:
-                print('Parallelization unavailable, computing...')
-            self._captured = True
-            self._computed = True
-            return True
-        elif not self._captured:
-            # If we haven't captured yet, then set the parallelizer for
-            # capturing and allow the loop to run
-            if progress:
-                print('Capturing for parallelization...')
-            self._captured = True
-            _set_parallelizer(self)
+        state = self._state
+        if state == _STATE_FRESH:
+            if self._backend is None:
+                # If we have no backend, then mark ourselves as computed the
+                # first time through, since we won't be doing any
+                # parallelization
+                if progress:
+                    print('Parallelization unavailable, computing...')
+                self._state = _STATE_COMPUTED
+            else:
+                # Otherwise grab the current persistent cache and validate it
+                # up front, so that we don't perform a full capture run only
+                # to discover that there's nowhere to store results
+                cache = _get_cache()
+                if cache is None:
+                    raise RuntimeError('not inside a cached context')
+                self._cache = cache
+                self._peek = getattr(cache, 'peek', None)
+
+                # Set the parallelizer for capturing
+                if progress:
+                    print('Capturing for parallelization...')
+                self._state = _STATE_CAPTURING
+                _set_parallelizer(self)
             return True
-        elif not self._computed:
+        elif state == _STATE_CAPTURING:
             # If we have already captured but haven't computed, then unset the
             # parallelizer and run the computations in a blocking manner, then
             # allow the loop to run to pull values out of the persistent cache
             if progress:
                 print('Computing in parallel...')
-            self._computed = True
+            self._state = _STATE_COMPUTED
             _set_parallelizer(None)
             self._compute(progress)
             return True
@@ -2,14 +2,202 @@
 """
 
 
+# System imports
+from collections import deque
+from pickle import loads
+
+# owls-cache imports
+from owls_cache.persistent import caching_into
+
+
+# The id of the persistent cache installed in this process by
+# _ensure_cache_installed, and the context used to install it
+_installed_cache_id = None
+_installed_cache_context = None
+
+
+def _ensure_cache_installed(cache_id, cache_data, cache = None):
+    """Installs a persistent cache for use by jobs in a worker process, unless
+    it is already installed.
+
+    The cache remains installed until a cache with a different id is
+    installed, so that jobs don't each have to unpickle the cache and enter
+    and exit a caching context.  This is intended for worker processes which
+    run jobs on a single thread.
+
+    Args:
+        cache_id: An id identifying the cache, e.g. a digest of its pickled
+            form
+        cache_data: The pickled persistent cache
+        cache: The persistent cache itself, if it is already available (e.g.
+            when inherited by a forked worker), in which case cache_data is
+            not used
+    """
+    # Check if the cache is already installed
+    global _installed_cache_id, _installed_cache_context
+    if cache_id == _installed_cache_id:
+        return
+
+    # Uninstall any previous cache
+    if _installed_cache_context is not None:
+        _installed_cache_context.__exit__(None, None, None)
+        _installed_cache_id = _installed_cache_context = None
+
+    # Install the new cache
+    if cache is None:
+        cache = loads(cache_data)
+    context = caching_into(cache)
+    context.__enter__()
+    _installed_cache_id, _installed_cache_context = cache_id, context
+
+
+def _flatten_spec(spec):
+    """Flattens a job specification into a list of batcher invocations, so that
+    workers can run it with a single loop (and so that it pickles more
+    compactly than the nested maps).
+
+    Args:
+        spec: A job specification, i.e. a map from batchers to maps from
+            functions to iterables of (args, kwargs) tuples
+
+    Returns:
+        A list of (batcher, function, args_kwargs) tuples, in order.
+    """
+    return [(batcher, function, args_kwargs)
+            for batcher, calls in spec.items()
+            for function, args_kwargs in calls.items()]
+
+
+class AggregateBatcherError(Exception):
+    """Raised by a job when more than one of its batcher invocations failed.
+
+    The exceptions raised by the failed invocations are available as the
+    `errors` attribute, a list of (function, exception) tuples, in order.
+    """
+
+    def __init__(self, errors):
+        """Initializes a new instance of the AggregateBatcherError class.
+
+        Args:
+            errors: A list of (function, exception) tuples
+        """
+        super(AggregateBatcherError, self).__init__(errors)
+        self.errors = errors
+
+    def __str__(self):
+        """Returns a summary of the failed invocations.
+        """
+        return '{0} batcher invocations failed: {1}'.format(
+            len(self.errors),
+            '; '.join('{0}: {1!r}'.format(getattr(f, '__name__', f), e)
+                      for f, e in self.errors)
+        )
+
+
+class JobSet(object):
+    """A collection of jobs, for use by backends which are notified of job
+    completions, which is pruned in place.
+
+    Jobs are added when they are started, and their completions (which may be
+    reported from any thread) are queued until the set is drained.  Draining
+    only processes newly-completed jobs, so pruning a JobSet costs time
+    proportional to the number of new completions rather than the number of
+    outstanding jobs, and doesn't require allocating a new collection.
+    """
+
+    def __init__(self):
+        """Initializes a new instance of the JobSet class.
+        """
+        self._alive = set()
+        self._incoming = deque()
+
+    def add(self, job):
+        """Adds an incomplete job to the set.
+
+        Args:
+            job: The job to add
+        """
+        self._alive.add(job)
+
+    def complete(self, job):
+        """Queues the completion of a job.  This method may be called from any
+        thread.
+
+        Args:
+            job: The job which has completed
+        """
+        self._incoming.append(job)
+
+    def drain(self):
+        """Removes jobs whose completions have been queued from the set.
+
+        This method should only be called from one thread at a time.
+
+        Returns:
+            A list of the jobs removed from the set.
+        """
+        completed = []
+        while self._incoming:
+            job = self._incoming.popleft()
+            if job in self._alive:
+                self._alive.remove(job)
+                completed.append(job)
+        return completed
+
+    def __len__(self):
+        """Returns the number of jobs in the set.
+        """
+        return len(self._alive)
+
+    def __iter__(self):
+        """Returns an iterator over the jobs in the set.
+        """
+        return iter(self._alive)
+
+
 class ParallelizationBackend(object):
     """The base class for all parallelization backends.  This backend should be
     subclassed by concrete implementations.
 
     All backends should be reusable - i.e. they should be able to handle
     multiple calls to `compute`.
+
+    Backends which are notified of job completions may additionally implement
+    a `completed_since` method, which the parallelization environment will
+    prefer over `prune` for monitoring.  It must be of the form:
+
+        completed_since(token)
+
+    where token is None on the first call and, on subsequent calls, the token
+    returned by the previous call.  It must return a tuple of the form:
+
+        (completed, token)
+
+    where completed is an iterable of the job objects (as returned by `start`)
+    which have completed since the call which returned the provided token, and
+    token is an opaque value to pass to the next call.  Like `prune`, it should
+    re-raise any exceptions raised by completed jobs.  This allows monitoring
+    cost to scale with the number of newly-completed jobs rather than the
+    number of outstanding jobs.  Job objects must be hashable to use this
+    mechanism.  Backends which return JobSets from `start` already get the
+    same scaling from `prune`, and needn't implement this method.
     """
 
+    # Backends which support incremental completion queries override this
+    # with a method (see above)
+    completed_since = None
+
+    # Backends whose start method can safely be called concurrently from
+    # multiple threads set this to True, allowing the parallelization
+    # environment to overlap submission of groups of jobs
+    parallel_submit = False
+
+    # Backends which know how many jobs they can run simultaneously set this
+    # to that number, allowing the parallelization environment to split large
+    # batches of work into multiple jobs to balance load across workers.  If
+    # None, job specifications are never split.
+    worker_count = None
+
     def start(self, cache, job_specs, callback):
         """Starts jobs on the backend, letting them run asynchronously.
 
@@ -32,7 +220,10 @@ class ParallelizationBackend(object):
                     ...
                 }
 
-                where a separate job should be created for each key
+                where each list of (args, kwargs) tuples may be any sized
+                iterable of such tuples, and where a separate job should be
+                created for each key.  Keys are ordered in the order in which
+                jobs should preferably be dispatched.
             callback: A callback which can be used to notify the
                 parallelization environment that new results are available.
                 Invocation of this callback is optional, as the environment
@@ -49,12 +240,13 @@ class ParallelizationBackend(object):
     def prune(self, jobs):
         """Prunes a collection of jobs by pruning those which are complete.
 
-        The input collection should not be modified.
+        The input collection should not be modified, unless it is a JobSet,
+        which may be drained in place and returned.
 
         Args:
             jobs: A collection of jobs to prune
 
         Returns:
-            A new collection of jobs which are still incomplete.
+            A collection of jobs which are still incomplete.
         """
         raise NotImplementedError('abstract method')
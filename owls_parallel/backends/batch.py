@@ -3,60 +3,286 @@
 
 
 # System imports
-from os.path import exists, isdir, join
+import ctypes
+import errno
+import itertools
+import json
+import os
+import re
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ctypes.util import find_library
+from hashlib import sha1
+from os.path import abspath, exists, isdir, join
 from os import makedirs
+from select import select
+from time import monotonic, sleep, time
+from weakref import WeakKeyDictionary
+from pickle import dumps, HIGHEST_PROTOCOL
 from subprocess import check_output, CalledProcessError, \
     STDOUT as MERGE_WITH_STDOUT
-from uuid import uuid4
-from base64 import b64encode
-
-# Six imports
-from six import itervalues
-from six.moves.cPickle import dumps
 
 # owls-parallel imports
-from owls_parallel.backends import ParallelizationBackend
+from owls_parallel.backends import ParallelizationBackend, JobSet, \
+    _flatten_spec
 
 
-# Template script for submission to the batch system
+# Template script for submission to the batch system as an array job.  The
+# persistent cache and jobs are stored in separate pickle files alongside the
+# script, with the cache file shared by all jobs in a submission and each array
+# task loading the job file corresponding to its (1-based) index.  The index is
+# taken from the first argument to the script if one is provided, otherwise
+# from the environment variable set by the batch system.  The CACHE_PATH and
+# JOB_PATH_PREFIX placeholders are replaced with the corresponding paths.
 _BATCH_TEMPLATE = """#!/usr/bin/env python
 
 # System imports
-from base64 import b64decode
-
-# Six imports
-from six.moves.cPickle import loads
-from six import iteritems
+import sys
+from os import environ
+from pickle import load
 
 # owls-cache imports
 from owls_cache.persistent import caching_into
 
+# Compute the array task index
+if len(sys.argv) > 1:
+    index = sys.argv[1]
+else:
+    index = (environ.get('PBS_ARRAYID')
+             or environ.get('PBS_ARRAY_INDEX')
+             or environ['SGE_TASK_ID'])
+
+# Load the persistent cache and job
+with open(CACHE_PATH, 'rb') as f:
+    cache = load(f)
+with open(JOB_PATH_PREFIX + index + '.pkl', 'rb') as f:
+    job = load(f)
+
 # Run the job
-job = loads(b64decode('{job}'))
-with caching_into(loads(b64decode('{cache}'))):
-    for batcher, calls in iteritems(job):
-        for function, args_kwargs in iteritems(calls):
-            batcher(function, args_kwargs)
+with caching_into(cache):
+    for batcher, function, args_kwargs in job:
+        batcher(function, args_kwargs)
 """
 
 
+# Split the batch script template into encoded fragments around the paths
+# which are substituted into it, so that scripts can be written without
+# formatting the template for each submission
+_BATCH_TEMPLATE_PREFIX, _BATCH_TEMPLATE_REST = \
+    _BATCH_TEMPLATE.encode('utf-8').split(b'CACHE_PATH')
+_BATCH_TEMPLATE_MIDDLE, _BATCH_TEMPLATE_SUFFIX = \
+    _BATCH_TEMPLATE_REST.split(b'JOB_PATH_PREFIX')
+
+
+# The buffer size to use when writing batch files, which is large enough that
+# most files are written with a single system call (batch directories are
+# often on network file systems, where each call is expensive)
+_WRITE_BUFFER_SIZE = 1 << 20
+
+
+def _write_file(path, data):
+    """Writes data to a file.
+
+    Args:
+        path: The path of the file
+        data: The bytes to write
+    """
+    with open(path, 'wb', _WRITE_BUFFER_SIZE) as f:
+        f.write(data)
+
+
+# Bounds for the interval, in seconds, between polls of the batch system
+_MINIMUM_POLL_INTERVAL = 0.1
+_MAXIMUM_POLL_INTERVAL = 60.0
+
+
+# The number of pending jobs at or below which the polling interval is capped,
+# and the cap, in seconds.  The interval still backs off up to the cap, so that
+# long-running final jobs don't cause the batch system to be queried
+# constantly.
+_TAIL_JOB_COUNT = 4
+_TAIL_POLL_INTERVAL = 5.0
+
+
+# The counter used to generate unique names for on-disk files, which is shared
+# by all backends in the process so that their names don't collide
+_name_counter = itertools.count()
+
+
+# The name of the file in which submitted jobs are recorded
+_SUBMISSION_RECORD_NAME = '.submitted.json'
+
+
+# The time, in seconds, beyond a backend's retention period after which
+# submitted jobs are removed from the record, since jobs generally won't still
+# be running by then
+_SUBMISSION_RECORD_GRACE = 24 * 60 * 60
+
+
+# inotify constants (from sys/inotify.h)
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_EVENT_HEADER = struct.Struct('iIII')
+
+
+# Regular expression to match the names of batch system output files, which
+# look like script.py.o123 (or script.py.o123-1 for array tasks)
+_OUTPUT_FILE_NAME = re.compile(br'\.o\d')
+
+
+class _OutputNotifier(object):
+    """Waits for batch system output files to appear in a directory.
+
+    On Linux, inotify is used to wake up as soon as an output file is written,
+    which batch systems generally do when jobs complete.  On other platforms
+    (or if inotify is unavailable), waiting simply sleeps for the full
+    timeout.
+    """
+
+    def __init__(self, path):
+        """Initializes a new instance of the _OutputNotifier class.
+
+        Args:
+            path: The directory to watch
+        """
+        # Try to create an inotify watch on the directory
+        self._fd = None
+        try:
+            libc = ctypes.CDLL(find_library('c'), use_errno = True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        if libc.inotify_add_watch(fd,
+                                  os.fsencode(path),
+                                  _IN_CLOSE_WRITE | _IN_MOVED_TO) < 0:
+            os.close(fd)
+            return
+        self._fd = fd
+
+    def _output_written(self):
+        """Reads pending inotify events.
+
+        Returns:
+            True if any of the events were for output files, False otherwise.
+        """
+        # Read whatever events are available
+        try:
+            data = os.read(self._fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return False
+            raise
+
+        # Check the names of the files in each event
+        result = False
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = _IN_EVENT_HEADER.unpack_from(data, offset)
+            offset += _IN_EVENT_HEADER.size
+            if _OUTPUT_FILE_NAME.search(data[offset:offset + length]):
+                result = True
+            offset += length
+
+        # All done
+        return result
+
+    def wait(self, timeout):
+        """Waits until an output file is written or the timeout expires.
+
+        Args:
+            timeout: The maximum time to wait, in seconds
+        """
+        # If we don't have inotify, then just sleep
+        if self._fd is None:
+            sleep(timeout)
+            return
+
+        # Otherwise wait for events until an output file shows up
+        deadline = monotonic() + timeout
+        while True:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return
+            readable, _, _ = select([self._fd], [], [], remaining)
+            if not readable or self._output_written():
+                return
+
+    def close(self):
+        """Closes the inotify watch, if any, after which waiting simply
+        sleeps.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
 class BatchParallelizationBackend(ParallelizationBackend):
     """A parallelization backend which uses a batch system to compute results.
+
+    Submitted jobs are monitored by a background thread, which polls the batch
+    system and notifies the parallelization environment as soon as it
+    observes jobs completing.  The thread exits when there are no more jobs to
+    watch and is restarted on the next submission.  If monitoring fails, the
+    thread exits and the error is re-raised when the jobs it was watching are
+    pruned.  The backend should be closed (or used as a context manager) once
+    it is no longer needed.
+
+    All jobs in a submission are submitted to the batch system as a single
+    array job, with one array task per job.
+
+    Submitted jobs are recorded (in the batch metadata path) by a digest of
+    their persistent cache and job data, and jobs identical to ones which are
+    still running (e.g. when retrying a computation) reuse the existing batch
+    jobs rather than being submitted again.
     """
 
-    def __init__(self, path, submit, monitor):
+    def __init__(self,
+                 path,
+                 submit,
+                 monitor,
+                 interval = 5,
+                 write_concurrency = 8,
+                 retention = 0):
         """Initializes a new instance of the BatchParallelizationBackend.
 
         Args:
             path: The path in which to store batch system metadata
-            submit: A function to submit jobs to the batch system, of the form:
-
-                    submit(working_directory, script_name)
-
-                which should return a string representing the job id
-            monitor: A function to monitor the status of a job on the batch
-                system, which should accept the job id as an argument and
-                return True if the job is complete, False otherwise
+            submit: A function to submit array jobs to the batch system, of
+                the form:
+
+                    submit(working_directory, script_name, array_size)
+
+                which should submit the script as an array job with tasks
+                indexed from 1 to array_size and return a list of strings
+                representing the job id of each task, in index order.  Each
+                task should be run with its index either passed as the first
+                argument to the script or stored in the PBS_ARRAYID,
+                PBS_ARRAY_INDEX, or SGE_TASK_ID environment variable.
+            monitor: A function to monitor the status of jobs on the batch
+                system, which should accept a list of job ids as an argument
+                and return a set containing those which are complete.  It is
+                called once per polling cycle for all pending jobs, so it
+                should query the batch system once rather than once per job.
+            interval: The initial interval, in seconds, at which to poll the
+                batch system for job status (defaults to 5).  The interval
+                is adapted as jobs run, doubling (up to 60 seconds, or the
+                initial interval if larger) after each poll which finds no
+                completed jobs and halving (down to 0.1 seconds) after each
+                poll which does, and is at most 5 seconds once there are 4
+                or fewer jobs remaining.  On Linux, the batch system is also
+                polled as soon as a batch output file is written to path,
+                since this generally indicates that a job has completed.
+            write_concurrency: The maximum number of threads to use for
+                writing job files, which allows file system latency for
+                different files to overlap (defaults to 8)
+            retention: The time, in seconds, after its submission for which a
+                completed job may be reused by identical jobs (defaults to 0,
+                in which case only jobs which are still running are reused).
+                Jobs are forgotten (and thus never reused) a day after this
+                time has passed.
         """
         # Make sure the path exists and store it
         if exists(path):
@@ -65,11 +291,181 @@ class BatchParallelizationBackend(ParallelizationBackend):
         else:
             # Just pass on exceptions
             makedirs(path)
-        self._path = path
+
+        # Store the path in absolute form, since it is embedded in batch
+        # scripts which may be run from a different working directory
+        self._path = abspath(path)
 
         # Store submission/monitoring commands and polling interval
         self._submit = submit
         self._monitor = monitor
+        self._interval = interval
+
+        # Load the record of submitted jobs, which maps job digests to job ids
+        # and submission times
+        self._retention = retention
+        self._submission_record_path = join(self._path,
+                                            _SUBMISSION_RECORD_NAME)
+        try:
+            with open(self._submission_record_path, 'r') as f:
+                self._submitted = json.load(f)
+        except (OSError, ValueError):
+            self._submitted = {}
+
+        # Create the prefix for names of on-disk files, which combines the
+        # creation time and process id so that names don't collide with those
+        # from other processes using the same path
+        self._name_prefix = '{0}_{1}'.format(int(time()), os.getpid())
+
+        # Create the thread pool used to write job files
+        self._writers = ThreadPoolExecutor(max_workers = write_concurrency)
+
+        # Create the notifier used to wake up between polls
+        self._notifier = _OutputNotifier(self._path)
+
+        # Create job tracking state, which is shared with the watcher thread.
+        # Pending jobs map job ids to lists of the notification callbacks and
+        # JobSets of the submissions they belong to (a job may belong to
+        # several submissions if it is reused), and the JobSets of submissions
+        # which couldn't be monitored map to the exception raised by the
+        # monitor.
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._errors = WeakKeyDictionary()
+        self._watcher = None
+
+    def _watch(self):
+        """Polls the batch system for the status of pending jobs until there
+        are none remaining, invoking notification callbacks for completions.
+
+        If polling fails, all pending jobs are abandoned, and the exception is
+        recorded for their submissions (which are notified) so that it can be
+        re-raised by prune.
+        """
+        try:
+            self._poll()
+        except Exception as e:
+            with self._lock:
+                callbacks = set()
+                for entries in self._pending.values():
+                    for callback, jobs in entries:
+                        self._errors[jobs] = e
+                        callbacks.add(callback)
+                self._pending = {}
+                self._watcher = None
+            for callback in callbacks:
+                callback()
+
+    def _poll(self):
+        """Polls the batch system until there are no pending jobs remaining.
+        """
+        # Compute polling bounds
+        interval = self._interval
+        maximum_interval = max(_MAXIMUM_POLL_INTERVAL, self._interval)
+
+        while True:
+            # Grab the jobs to check, exiting if there are none
+            with self._lock:
+                pending = list(self._pending)
+                if not pending:
+                    self._watcher = None
+                    return
+
+            # Check for completed jobs
+            completed = self._monitor(pending)
+
+            # Record completions and send notifications
+            if completed:
+                with self._lock:
+                    callbacks = set()
+                    for j in completed:
+                        for callback, jobs in self._pending.pop(j, ()):
+                            callbacks.add(callback)
+                            jobs.complete(j)
+                for callback in callbacks:
+                    callback()
+
+            # Adapt the polling interval, backing off while jobs aren't
+            # completing and polling eagerly while they are, with a lower cap
+            # on the interval when only a few remain
+            if completed:
+                interval = max(_MINIMUM_POLL_INTERVAL, interval / 2)
+            else:
+                interval = min(maximum_interval, interval * 2)
+            if len(pending) - len(completed) <= _TAIL_JOB_COUNT:
+                interval = min(interval, _TAIL_POLL_INTERVAL)
+
+            # Wait for the next poll
+            self._notifier.wait(interval)
+
+    def _next_name(self):
+        """Generates a unique name for on-disk files.
+
+        Returns:
+            The name.
+        """
+        return '{0}_{1}'.format(self._name_prefix, next(_name_counter))
+
+    def _reusable_jobs(self, digests):
+        """Finds previously submitted jobs which can be reused, forgetting
+        those which can't.
+
+        Args:
+            digests: The digests of the jobs to look for
+
+        Returns:
+            A dictionary mapping the digests of reusable jobs to job ids.
+        """
+        # Find recorded jobs
+        candidates = dict((d, self._submitted[d])
+                          for d
+                          in digests
+                          if d in self._submitted)
+
+        # Recently submitted jobs can be reused whatever their state, but
+        # other jobs can only be reused if they are still running, which we
+        # check for with a single query
+        now = time()
+        result = dict((d, job_id)
+                      for d, (job_id, submission_time)
+                      in candidates.items()
+                      if now - submission_time <= self._retention)
+        check = [job_id
+                 for d, (job_id, _)
+                 in candidates.items()
+                 if d not in result]
+        if check:
+            completed = self._monitor(check)
+            for d, (job_id, _) in candidates.items():
+                if d not in result and job_id not in completed:
+                    result[d] = job_id
+
+        # Forget jobs which can't be reused
+        for d in candidates:
+            if d not in result:
+                del self._submitted[d]
+
+        # All done
+        return result
+
+    def _save_submission_record(self):
+        """Saves the record of submitted jobs, forgetting those which are
+        too old to be reused.
+        """
+        # Forget old jobs, so that the record doesn't grow without bound
+        cutoff = time() - self._retention - _SUBMISSION_RECORD_GRACE
+        self._submitted = dict((d, entry)
+                               for d, entry
+                               in self._submitted.items()
+                               if entry[1] >= cutoff)
+
+        # Write to a temporary file and move it into place, so that the record
+        # is never left partially written
+        temporary_path = '{0}.{1}'.format(self._submission_record_path,
+                                          self._next_name())
+        with open(temporary_path, 'w') as f:
+            json.dump(self._submitted, f)
+        os.replace(temporary_path, self._submission_record_path)
 
     def start(self, cache, job_specs, callback):
         """Run jobs on the backend, blocking until their completion.
@@ -78,78 +474,365 @@ class BatchParallelizationBackend(ParallelizationBackend):
             cache: The persistent cache which should be set on the backend
             job_specs: The job specification (see
                 owls_parallel.backends.ParallelizationBackend)
-            callback: The job notification callback, not used by this backend
+            callback: The job notification callback
         """
-        # Create the result list
-        results = []
-
-        # Go through each job and create a batch job for it
-        for spec in itervalues(job_specs):
-            # Create the job content
-            batch_script = _BATCH_TEMPLATE.format(**{
-                "cache": b64encode(dumps(cache)),
-                "job": b64encode(dumps(spec)),
-            })
-
-            # Create an on-disk handle
-            script_name = '{0}.py'.format(uuid4().hex)
+        # If there are no jobs, then there's nothing to submit
+        if not job_specs:
+            return JobSet()
+
+        # Serialize the persistent cache once for all jobs, and serialize each
+        # job, computing a digest identifying it
+        cache_data = dumps(cache, HIGHEST_PROTOCOL)
+        cache_digest = sha1(cache_data).digest()
+        job_data = [dumps(_flatten_spec(spec), HIGHEST_PROTOCOL)
+                    for spec
+                    in job_specs.values()]
+        digests = [sha1(cache_digest + d).hexdigest() for d in job_data]
+
+        # Look for previously submitted jobs which can be reused, and figure
+        # out which jobs need to be submitted
+        record_size = len(self._submitted)
+        reused = self._reusable_jobs(digests)
+        new = [i for i, d in enumerate(digests) if d not in reused]
+
+        # Create the result list, filling in the reused jobs
+        results = [reused.get(d) for d in digests]
+
+        # Submit new jobs
+        if new:
+            # Create on-disk handles
+            name = self._next_name()
+            script_name = '{0}.py'.format(name)
             script_path = join(self._path, script_name)
-
-            # Write it to file
-            with open(script_path, 'w') as f:
-                f.write(batch_script)
-
-            # Submit the batch job and record the job id
-            results.append(self._submit(self._path, script_name))
+            cache_path = join(self._path, '{0}.cache.pkl'.format(name))
+            job_path_prefix = join(self._path, '{0}.'.format(name))
+
+            # Write the persistent cache and job files, indexing jobs from 1 to
+            # match array task indices.  Files are written concurrently.
+            writes = [
+                self._writers.submit(_write_file, cache_path, cache_data)
+            ]
+            for index, i in enumerate(new, 1):
+                writes.append(self._writers.submit(
+                    _write_file,
+                    '{0}{1}.pkl'.format(job_path_prefix, index),
+                    job_data[i]
+                ))
+
+            # Write the script to file
+            with open(script_path, 'wb', _WRITE_BUFFER_SIZE) as f:
+                f.write(_BATCH_TEMPLATE_PREFIX)
+                f.write(repr(cache_path).encode('utf-8'))
+                f.write(_BATCH_TEMPLATE_MIDDLE)
+                f.write(repr(job_path_prefix).encode('utf-8'))
+                f.write(_BATCH_TEMPLATE_SUFFIX)
+
+            # Wait for job files to be written, re-raising any errors
+            for write in writes:
+                write.result()
+
+            # Submit all new jobs as a single array job and record the task
+            # job ids
+            job_ids = self._submit(self._path, script_name, len(new))
+            submission_time = time()
+            for i, job_id in zip(new, job_ids):
+                results[i] = job_id
+                self._submitted[digests[i]] = [job_id, submission_time]
+
+        # Save the record of submitted jobs if it has changed
+        if new or len(self._submitted) != record_size:
+            self._save_submission_record()
+
+        # Start watching the jobs, starting the watcher thread if necessary
+        jobs = JobSet()
+        with self._lock:
+            for job_id in results:
+                jobs.add(job_id)
+                self._pending.setdefault(job_id, []).append((callback, jobs))
+            if self._watcher is None and results:
+                self._watcher = threading.Thread(target = self._watch)
+                self._watcher.daemon = True
+                self._watcher.start()
 
         # All done
-        return results
+        return jobs
 
     def prune(self, jobs):
         """Prunes a collection of jobs by pruning those which are complete.
 
-        The input collection should not be modified.
+        The collection is pruned in place.
 
         Args:
-            jobs: A collection of jobs to prune
+            jobs: The JobSet to prune
 
         Returns:
-            A new collection of jobs which are still incomplete.
+            The JobSet.
         """
-        return [j for j in jobs if not self._monitor(j)]
+        # Re-raise any error which prevented the jobs from being monitored
+        with self._lock:
+            error = self._errors.get(jobs)
+        if error is not None:
+            raise error
+
+        # Remove completed jobs
+        jobs.drain()
 
+        # All done
+        return jobs
 
-def qsub_submit(working_directory, script_name):
+    def close(self):
+        """Closes the backend, waiting for the monitoring of outstanding jobs
+        to finish and releasing the resources used to watch for job output
+        and to write job files.
+
+        The backend can't be used to start jobs after it is closed.
+        """
+        # Wait for the watcher thread to exit, if it is running
+        with self._lock:
+            watcher = self._watcher
+        if watcher is not None:
+            watcher.join()
+
+        # Release resources
+        self._notifier.close()
+        self._writers.shutdown()
+
+    def __enter__(self):
+        """Enters a context which closes the backend on exit.
+
+        Returns:
+            The backend.
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Closes the backend.
+        """
+        self.close()
+
+
+def qsub_submit(working_directory, script_name, array_size):
     """Provides batch submission capabilities for portable batch systems.
 
     Args:
         working_directory: The working directory for the batch job
         script_name: The name of the script to submit
+        array_size: The number of tasks in the array job
 
     Returns:
-        The job id.
+        A list of the job ids of the array tasks.
     """
-    return check_output(['qsub', '-l', 'cput=1:00:00,walltime=1:00:00',
-                         script_name],
-                        cwd = working_directory).strip('\n')
+    # Submit the array job, which will give us an id of the form 123[].server
+    job_id = check_output(['qsub', '-l', 'cput=1:00:00,walltime=1:00:00',
+                           '-t', '1-{0}'.format(array_size),
+                           script_name],
+                          cwd = working_directory).decode('utf-8').strip()
 
+    # Compute the ids of the individual tasks
+    return [job_id.replace('[]', '[{0}]'.format(i), 1)
+            for i
+            in range(1, array_size + 1)]
+
+
+# Regular expression to extract the job sequence number and state from rows of
+# qstat output, which look like:
+#   123.server   script.py   user   00:00:00 R batch
+# Job ids may be truncated in qstat output, so we only match the numeric
+# sequence number (and array index, if any) at the start of each row.
+_QSTAT_ROW = re.compile(r'^(\d+(?:\[\d*\])?)\S*\s.*\s([A-Z])\s+\S+\s*$',
+                        re.MULTILINE)
 
-def qsub_monitor(job_id):
-    """Provides batch monitoring capabilities for portable batch systems.
+
+# The qstat states which indicate that a job has completed
+_QSTAT_COMPLETED_STATES = frozenset(('C', 'F', 'X'))
+
+
+# Utility function to extract the sequence number of a batch job id
+def _qstat_sequence_number(job_id):
+    return job_id.split('.', 1)[0]
+
+
+def _capture_output(command):
+    """Runs a command and captures its combined standard output and error,
+    ignoring its exit status.
+
+    Where available, posix_spawnp is used to launch the command, which avoids
+    the cost of forking the current process (which grows with its memory
+    footprint, e.g. when a large persistent cache is loaded).
 
     Args:
-        job_id: The job id to check
+        command: The command to run, as a list of arguments
 
     Returns:
-        True if the job has completed, False otherwise.
+        The output of the command, as bytes.
     """
+    # If we don't have posix_spawnp, then use subprocess
+    if not hasattr(os, 'posix_spawnp'):
+        try:
+            return check_output(command, stderr = MERGE_WITH_STDOUT)
+        except CalledProcessError as e:
+            return e.output
+
+    # Launch the command with its output directed into a pipe, making sure
+    # that neither end of the pipe is leaked if it can't be launched
+    read_fd, write_fd = os.pipe()
     try:
-        # If the qstat command returns a 0 exit code, it means the jobs was
-        # found, which means it is running
-        check_output(['qstat', job_id], stderr = MERGE_WITH_STDOUT)
-        return False
-    except CalledProcessError:
-        # If the qstat command returns a non-0 exit code, it means the job was
-        # not found, which means it is not running, and *hopefully* means that
-        # it finished successfully
-        return True
+        file_actions = [(os.POSIX_SPAWN_DUP2, write_fd, 1),
+                        (os.POSIX_SPAWN_DUP2, write_fd, 2)]
+        pid = os.posix_spawnp(command[0],
+                              command,
+                              os.environ,
+                              file_actions = file_actions)
+    except BaseException:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+
+    # Read the output until the command closes its end of the pipe
+    chunks = []
+    try:
+        while True:
+            chunk = os.read(read_fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(read_fd)
+
+    # Reap the command
+    os.waitpid(pid, 0)
+
+    # All done
+    return b''.join(chunks)
+
+
+def qsub_monitor(job_ids):
+    """Provides batch monitoring capabilities for portable batch systems.
+
+    All jobs are queried with a single invocation of qstat, which reports the
+    state of array tasks individually.
+
+    Args:
+        job_ids: The job ids to check
+
+    Returns:
+        The set of job ids which have completed.
+    """
+    # Query the status of all jobs.  qstat will return a non-0 exit code if
+    # any of the jobs weren't found, but will still print the status of those
+    # that were.
+    output = _capture_output(['qstat', '-t'] + list(job_ids))
+
+    # Find the completed jobs
+    return _qstat_completed(job_ids, output.decode('utf-8'))
+
+
+def _qstat_completed(job_ids, output):
+    """Finds the jobs which have completed according to the output of qstat.
+
+    Args:
+        job_ids: The job ids which were queried
+        output: The output of qstat -t for the jobs, as a string
+
+    Returns:
+        The set of job ids which have completed.
+    """
+    # Extract the states of jobs which were found
+    states = dict(_QSTAT_ROW.findall(output))
+
+    # Jobs are complete if they are listed as such, or if they weren't found,
+    # which means they are not running, and *hopefully* means that they
+    # finished successfully
+    return set(j
+               for j
+               in job_ids
+               if states.get(_qstat_sequence_number(j), 'C')
+               in _QSTAT_COMPLETED_STATES)
+
+
+class DRMAASession(object):
+    """Provides batch submission and monitoring capabilities via a DRMAA
+    session, as an alternative to qsub_submit and qsub_monitor.
+
+    Rather than spawning a qsub/qstat process for each operation, a single
+    DRMAA session (and job template) is created and reused for all submissions
+    and status queries.  This requires the drmaa Python module, as well as a
+    DRMAA library for the batch system.
+
+    The submit and monitor methods of an instance should be passed to the
+    BatchParallelizationBackend constructor.
+    """
+
+    def __init__(self,
+                 native_specification = '-l cput=1:00:00,walltime=1:00:00'):
+        """Initializes a new instance of the DRMAASession class.
+
+        Args:
+            native_specification: Native batch system options to use for
+                submitted jobs (defaults to the same resource limits used by
+                qsub_submit)
+        """
+        # Import drmaa lazily, since it is an optional dependency
+        import drmaa
+        self._drmaa = drmaa
+
+        # Create the session
+        self._session = drmaa.Session()
+        self._session.initialize()
+
+        # Create the job template, running scripts the same way as their
+        # shebang lines would
+        self._template = self._session.createJobTemplate()
+        self._template.remoteCommand = '/usr/bin/env'
+        self._template.nativeSpecification = native_specification
+
+    def submit(self, working_directory, script_name, array_size):
+        """Submits an array job to the batch system.
+
+        Args:
+            working_directory: The working directory for the batch job
+            script_name: The name of the script to submit
+            array_size: The number of tasks in the array job
+
+        Returns:
+            A list of the job ids of the array tasks.
+        """
+        self._template.workingDirectory = working_directory
+        self._template.args = ['python',
+                               script_name,
+                               self._drmaa.JobTemplate.PARAMETRIC_INDEX]
+        return self._session.runBulkJobs(self._template, 1, array_size, 1)
+
+    def monitor(self, job_ids):
+        """Monitors jobs on the batch system.
+
+        Args:
+            job_ids: The job ids to check
+
+        Returns:
+            The set of job ids which have completed.
+        """
+        # Compute the set of states which indicate completion
+        completed_states = (self._drmaa.JobState.DONE,
+                            self._drmaa.JobState.FAILED)
+
+        # Check each job
+        result = set()
+        for job_id in job_ids:
+            try:
+                if self._session.jobStatus(job_id) in completed_states:
+                    result.add(job_id)
+            except self._drmaa.errors.InvalidJobException:
+                # The batch system doesn't know about the job anymore, which
+                # means it is not running
+                result.add(job_id)
+
+        # All done
+        return result
+
+    def close(self):
+        """Closes the DRMAA session.
+        """
+        self._session.deleteJobTemplate(self._template)
+        self._session.exit()
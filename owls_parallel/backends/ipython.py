@@ -2,43 +2,170 @@
 """
 
 
-# Six imports
-from six import iteritems, itervalues
+# System imports
+from functools import partial
+from hashlib import sha1
+from pickle import dumps, HIGHEST_PROTOCOL
+from time import monotonic
 
-# IPython imports
-from IPython.parallel import Client
+# owls-parallel imports
+from owls_parallel.backends import ParallelizationBackend, \
+    _ensure_cache_installed, _flatten_spec
 
-# owls-cache imports
-from owls_cache.persistent import caching_into
 
-# owls-parallel imports
-from owls_parallel.backends import ParallelizationBackend
+# The name of the variable in the engine namespace into which the pickled
+# persistent cache is pushed
+_CACHE_DATA_NAME = '_owls_cache_data'
+
+
+# The estimated time, in seconds, taken by each call of a function whose cost
+# hasn't been observed yet
+_DEFAULT_CALL_TIME = 0.001
+
+
+# The weight given to each new observation of the time taken by calls of a
+# function when updating its estimated cost
+_CALL_TIME_SMOOTHING = 0.3
 
 
-# Create a function to execute jobs on the cluster
-def _run(cache, job):
-    with caching_into(cache):
-        for batcher, calls in iteritems(job):
-            for function, args_kwargs in iteritems(calls):
-                batcher(function, args_kwargs)
+# Create a function to execute packs of jobs on the cluster.  The pickled
+# persistent cache is pushed to the namespace of each engine ahead of time
+# (which is the __main__ module on engines), and jobs are sent along with its
+# digest, so that engines only have to install it once.  Jobs are sent in
+# flattened form.  The number of calls made and the time taken for each
+# function in each job are returned (in order) so that the cost of future jobs
+# can be estimated.
+def _run(cache_digest, jobs):
+    import __main__
+    _ensure_cache_installed(cache_digest,
+                            getattr(__main__, _CACHE_DATA_NAME))
+    timings = []
+    for job in jobs:
+        for batcher, function, args_kwargs in job:
+            start = monotonic()
+            batcher(function, args_kwargs)
+            timings.append((len(args_kwargs), monotonic() - start))
+    return timings
+
+
+class _TaskPacker(object):
+    """Packs jobs together into tasks based on their estimated cost.
+
+    The cost of jobs is estimated from the observed time taken by previous
+    calls of the same functions, smoothed with an exponentially-weighted
+    moving average.
+    """
+
+    def __init__(self, target_task_time):
+        """Initializes a new instance of the _TaskPacker class.
+
+        Args:
+            target_task_time: The estimated time, in seconds, up to which jobs
+                should be packed together into a single task
+        """
+        # Store the target and create the map from (batcher, function) pairs
+        # to the estimated time taken by each call of the function
+        self._target_task_time = target_task_time
+        self._call_times = {}
+
+    def estimate_cost(self, job):
+        """Estimates the time taken to run a job.
+
+        Args:
+            job: The flattened job specification
+
+        Returns:
+            The estimated time, in seconds.
+        """
+        result = 0.0
+        for batcher, function, args_kwargs in job:
+            call_time = self._call_times.get((batcher, function),
+                                             _DEFAULT_CALL_TIME)
+            result += call_time * len(args_kwargs)
+        return result
+
+    def record_timings(self, keys, timings):
+        """Updates cost estimates with the time taken by calls in a task.
+
+        Args:
+            keys: The keys identifying the functions called in the task
+            timings: The timings returned by _run for the task
+        """
+        for key, (count, elapsed) in zip(keys, timings):
+            call_time = elapsed / max(1, count)
+            previous = self._call_times.get(key)
+            if previous is None:
+                self._call_times[key] = call_time
+            else:
+                self._call_times[key] = \
+                    previous + _CALL_TIME_SMOOTHING * (call_time - previous)
+
+    def pack(self, jobs, worker_count):
+        """Greedily packs consecutive jobs into tasks whose estimated cost is
+        below the target, without packing so much that there are fewer tasks
+        than workers.
+
+        Args:
+            jobs: The flattened job specifications
+            worker_count: The number of workers which will run the tasks
+
+        Returns:
+            A list of tasks, each of which is a list of jobs, in order.
+        """
+        costs = [self.estimate_cost(j) for j in jobs]
+        target = min(self._target_task_time,
+                     sum(costs) / max(1, worker_count))
+        packs = []
+        for job, cost in zip(jobs, costs):
+            if packs and pack_cost + cost <= target:
+                packs[-1].append(job)
+                pack_cost += cost
+            else:
+                packs.append([job])
+                pack_cost = cost
+        return packs
 
 
 class IPythonParallelizationBackend(ParallelizationBackend):
     """A parallelization backend which uses an IPython cluster to compute
     results.
+
+    Small jobs are packed together into tasks, so that the per-task overhead
+    of the cluster is amortized.  The cost of jobs is estimated from the
+    observed time taken by previous calls of the same functions.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, target_task_time = 0.1, **kwargs):
         """Initializes a new instance of the IPythonParallelizationBackend.
 
-        Args: The same as the IPython.parallel.Client class
+        Args: The same as the IPython.parallel.Client class, plus:
+            target_task_time: The estimated time, in seconds, up to which jobs
+                should be packed together into a single task (defaults to 0.1)
         """
+        # Import IPython lazily, so that the rest of this module can be used
+        # without it
+        from IPython.parallel import Client
+
         # Create the client
         self._client = Client(*args, **kwargs)
 
         # Create the cluster view
         self._cluster = self._client.load_balanced_view()
 
+        # Track the digest of the persistent cache pushed to engines, and the
+        # engines it was pushed to
+        self._pushed_cache_digest = None
+        self._pushed_engines = frozenset()
+
+        # Create the task packer
+        self._packer = _TaskPacker(target_task_time)
+
+    @property
+    def worker_count(self):
+        """The number of engines currently registered with the cluster.
+        """
+        return len(self._client.ids)
+
     def start(self, cache, job_specs, callback):
         """Run jobs on the backend, blocking until their completion.
 
@@ -48,9 +175,41 @@ class IPythonParallelizationBackend(ParallelizationBackend):
                 owls_parallel.backends.ParallelizationBackend)
             callback: The job notification callback, not used by this backend
         """
-        return [self._cluster.apply_async(_run, cache, j)
-                for j
-                in itervalues(job_specs)]
+        # If there are no jobs, then there's nothing to submit
+        jobs = [_flatten_spec(j) for j in job_specs.values()]
+        if not jobs:
+            return []
+
+        # Serialize the persistent cache and broadcast it to all engines,
+        # unless they already have it
+        cache_data = dumps(cache, HIGHEST_PROTOCOL)
+        cache_digest = sha1(cache_data).digest()
+        engines = frozenset(self._client.ids)
+        if cache_digest != self._pushed_cache_digest \
+                or engines != self._pushed_engines:
+            self._client[:].push({_CACHE_DATA_NAME: cache_data},
+                                 block = True)
+            self._pushed_cache_digest = cache_digest
+            self._pushed_engines = engines
+
+        # Pack jobs into tasks
+        packs = self._packer.pack(jobs, self.worker_count)
+
+        # Submit all tasks with a single map call
+        result = self._cluster.map_async(partial(_run, cache_digest),
+                                         packs,
+                                         chunksize = 1,
+                                         ordered = False)
+
+        # Track completion of each task individually, along with the keys of
+        # the functions it calls
+        return [(result,
+                 msg_id,
+                 tuple((batcher, function)
+                       for job in pack
+                       for batcher, function, _ in job))
+                for msg_id, pack
+                in zip(result.msg_ids, packs)]
 
     def prune(self, jobs):
         """Prunes a collection of jobs by pruning those which are complete.
@@ -63,14 +222,23 @@ class IPythonParallelizationBackend(ParallelizationBackend):
         Returns:
             A new collection of jobs which are still incomplete.
         """
-        # Extract unfinished jobs, and re-raise any remote exceptions
+        # Process any pending results from the controller
+        self._client.spin()
+
+        # Extract unfinished jobs, re-raising any remote exceptions and
+        # recording the timings of completed jobs.  Each map chunk returns a
+        # list containing the result of its (single) task.
         result = []
         for j in jobs:
-            if j.ready():
-                # This will re-raise remotely-raised exceptions locally
-                j.get()
-            else:
+            _, msg_id, keys = j
+            if msg_id in self._client.outstanding:
                 result.append(j)
+                continue
+            outcome = self._client.results.get(msg_id)
+            if isinstance(outcome, Exception):
+                raise outcome
+            if outcome:
+                self._packer.record_timings(keys, outcome[0])
 
         # All done
         return result
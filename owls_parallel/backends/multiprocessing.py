@@ -2,44 +2,606 @@
 """
 
 
-# HACK: Use absolute_import behavior to get around module having the same name
-# as the global multiprocessing module
-from __future__ import absolute_import
-
 # System imports
-from multiprocessing import Pool
+import os
+import threading
+from importlib import import_module
+from itertools import count
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
+from multiprocessing import get_context
+from multiprocessing.pool import RemoteTraceback
+from hashlib import sha1
+from pickle import dumps, loads, HIGHEST_PROTOCOL
+from traceback import format_exc
+
+# owls-parallel imports
+from owls_parallel.backends import ParallelizationBackend, JobSet, \
+    AggregateBatcherError, _ensure_cache_installed, _flatten_spec
 
-# Six imports
-from six import iteritems, itervalues
 
-# owls-cache imports
-from owls_cache.persistent import caching_into
+# The queue on which workers report job completions
+_completion_queue = None
 
-# owls-parallel imports
-from owls_parallel.backends import ParallelizationBackend
 
+# Create a function to initialize workers.  The persistent cache is installed
+# when the pool is created, rather than for each job.  Forked workers inherit
+# the cache object itself, whereas other workers are sent it in pickled form.
+# Any requested modules are imported up front, so that the first jobs run by
+# the worker don't pay for their import.
+def _initialize(completion_queue,
+                cache_id,
+                cache_data,
+                cache,
+                preimport,
+                initializer,
+                initargs):
+    global _completion_queue
+    _completion_queue = completion_queue
+    for module in preimport:
+        import_module(module)
+    _ensure_cache_installed(cache_id, cache_data, cache)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+# Shared memory blocks which couldn't be closed after their job finished,
+# because something still referenced an array backed by them.  Closing them is
+# retried after each subsequent job.
+_lingering_shared_memory = []
+
+
+class _SharedArray(object):
+    """Refers to a NumPy array which has been copied into shared memory, in
+    place of the array itself.
+    """
+
+    def __init__(self, name, shape, dtype):
+        """Creates a new reference.
+
+        Args:
+            name: The name of the shared memory block
+            shape: The shape of the array
+            dtype: The data type of the array
+        """
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+
+def _share_arrays(job, threshold, shared):
+    """Replaces large NumPy array arguments in a flattened job with references
+    to copies of them in shared memory.
+
+    Only arrays passed directly as positional or keyword arguments are
+    replaced, and arrays of Python objects are never replaced.
+
+    Args:
+        job: The flattened job (see owls_parallel.backends._flatten_spec)
+        threshold: The minimum size (in bytes) of arrays to replace
+        shared: A dictionary, shared between jobs, mapping the ids of arrays
+            which have already been copied into shared memory to tuples of
+            the form (reference, shared_memory).  Blocks are added as soon as
+            they are created, so that they can be released if this function
+            fails.
+
+    Returns:
+        A tuple of the form (job, names), where job is the job with arrays
+        replaced and names is a tuple of the names of the shared memory blocks
+        it refers to.
+    """
+    # Import NumPy lazily, since it's an optional dependency, and shared
+    # memory lazily, since it requires Python 3.8
+    import numpy
+    from multiprocessing.shared_memory import SharedMemory
+
+    # Create a function to replace a single argument
+    names = set()
+
+    def share(value):
+        if not isinstance(value, numpy.ndarray) \
+                or value.nbytes == 0 \
+                or value.nbytes < threshold \
+                or value.dtype.hasobject:
+            return value
+        entry = shared.get(id(value))
+        if entry is None:
+            memory = SharedMemory(create = True, size = value.nbytes)
+            reference = _SharedArray(memory.name, value.shape, value.dtype)
+            entry = shared[id(value)] = (reference, memory)
+            numpy.ndarray(value.shape,
+                          value.dtype,
+                          buffer = memory.buf)[...] = value
+        names.add(entry[0].name)
+        return entry[0]
+
+    # Replace arguments
+    result = []
+    for batcher, function, args_kwargs in job:
+        result.append((batcher, function, [
+            (tuple(share(a) for a in args),
+             dict((k, share(v)) for k, v in kwargs.items()))
+            for args, kwargs in args_kwargs
+        ]))
+
+    # All done
+    return result, tuple(names)
+
+
+def _attach_arrays(job, attached):
+    """Replaces references to arrays in shared memory in a flattened job with
+    arrays backed by that shared memory.
+
+    Args:
+        job: The flattened job (see owls_parallel.backends._flatten_spec)
+        attached: A dictionary, shared between calls, mapping the names of
+            shared memory blocks which have been attached to tuples of the
+            form (shared_memory, array)
+
+    Returns:
+        The job with references replaced.
+    """
+    # Import NumPy lazily, since it's an optional dependency, and shared
+    # memory lazily, since it requires Python 3.8
+    import numpy
+    from multiprocessing.shared_memory import SharedMemory
 
-# Create a function to execute jobs on the cluster
-def _run(cache, job):
-    with caching_into(cache):
-        for batcher, calls in iteritems(job):
-            for function, args_kwargs in iteritems(calls):
+    # Create a function to replace a single argument.  Each block is attached
+    # once, so that an array passed to several calls is the same object in
+    # each of them.  Arrays are made read-only, since the same block may be
+    # used by other jobs.
+    def attach(value):
+        if not isinstance(value, _SharedArray):
+            return value
+        entry = attached.get(value.name)
+        if entry is None:
+            memory = SharedMemory(value.name)
+            array = numpy.ndarray(value.shape,
+                                  value.dtype,
+                                  buffer = memory.buf)
+            array.flags.writeable = False
+            entry = attached[value.name] = (memory, array)
+        return entry[1]
+
+    # Replace arguments
+    return [(batcher, function, [
+        (tuple(attach(a) for a in args),
+         dict((k, attach(v)) for k, v in kwargs.items()))
+        for args, kwargs in args_kwargs
+    ]) for batcher, function, args_kwargs in job]
+
+
+def _close_shared_memory(memories):
+    """Closes shared memory blocks attached by a worker, deferring those which
+    are still in use.
+
+    Args:
+        memories: The shared memory blocks to close
+    """
+    remaining = []
+    for memory in memories:
+        try:
+            memory.close()
+        except BufferError:
+            remaining.append(memory)
+    _lingering_shared_memory[:] = remaining
+
+
+def _release_shared_memory(memories):
+    """Closes and removes shared memory blocks created by the backend.
+
+    Args:
+        memories: The shared memory blocks to release
+    """
+    for memory in memories:
+        memory.close()
+        memory.unlink()
+
+
+# Create a function to execute jobs on the cluster.  Jobs are sent in flattened
+# and pickled form along with their ids, and each job reports its id on the
+# completion queue as soon as it finishes, along with any exception that it
+# raised (or, if that exception can't be pickled, a description of it) and its
+# formatted traceback, so that completions are seen individually even though
+# jobs are submitted in chunks.  Jobs which refer to arrays in shared memory
+# are flagged, so that other jobs don't need to be scanned.  Results reach the
+# parent through the persistent cache, so the values returned by batchers are
+# dropped as soon as each batcher returns and nothing is returned through the
+# pool.  Likewise, tracebacks are dropped once they have been formatted, so
+# that the frames they refer to don't keep job arguments alive.  A failed
+# batcher invocation doesn't stop the others in the job from running, and if
+# several fail then their exceptions are reported together.
+def _run(job_id_job_shared):
+    job_id, job, shared = job_id_job_shared
+    error = traceback = None
+    attached = {}
+    try:
+        job = loads(job)
+        if shared:
+            job = _attach_arrays(job, attached)
+        errors = []
+        for batcher, function, args_kwargs in job:
+            try:
                 batcher(function, args_kwargs)
+            except Exception as e:
+                traceback = format_exc()
+                errors.append((function, e.with_traceback(None), traceback))
+        if len(errors) == 1:
+            _, error, traceback = errors[0]
+        elif errors:
+            error = AggregateBatcherError([(f, e) for f, e, _ in errors])
+            traceback = ''.join(t for _, _, t in errors)
+    except Exception as e:
+        traceback = format_exc()
+        error = e.with_traceback(None)
+    if shared or _lingering_shared_memory:
+        job = None
+        memories = [m for m, _ in attached.values()]
+        attached.clear()
+        _close_shared_memory(_lingering_shared_memory + memories)
+    try:
+        _completion_queue.put((job_id, error, traceback))
+    except Exception:
+        _completion_queue.put((job_id, RuntimeError(repr(error)), traceback))
+
+
+def _merge_specs(job_specs, parts):
+    """Merges the calls from all job specifications by batcher and function,
+    producing flattened jobs which each invoke a batcher once.
+
+    The calls for each batcher are split into at most roughly `parts` jobs,
+    so that work can still be distributed across workers.
+
+    Args:
+        job_specs: The job specification (see
+            owls_parallel.backends.ParallelizationBackend)
+        parts: The number of jobs to aim for per batcher
+
+    Returns:
+        A list of flattened jobs (see owls_parallel.backends._flatten_spec).
+    """
+    # Merge calls across specifications
+    merged = OrderedDict()
+    for spec in job_specs.values():
+        for batcher, calls in spec.items():
+            functions = merged.setdefault(batcher, OrderedDict())
+            for function, args_kwargs in calls.items():
+                functions.setdefault(function, []).extend(args_kwargs)
+
+    # Split the merged calls for each batcher into jobs
+    result = []
+    for batcher, functions in merged.items():
+        total = sum(len(c) for c in functions.values())
+        size = max(1, -(-total // parts))
+        for function, calls in functions.items():
+            for i in range(0, len(calls), size):
+                result.append([(batcher, function, calls[i:i + size])])
+
+    # All done
+    return result
 
 
 class MultiprocessingParallelizationBackend(ParallelizationBackend):
     """A parallelization backend which uses a multiprocessing pool to compute
     results.
+
+    Jobs are submitted to the pool in chunks, and workers report their
+    completions on a queue which is read by a background thread, so checking
+    for completed jobs doesn't require polling each job individually.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self,
+                 processes = None,
+                 initializer = None,
+                 initargs = (),
+                 maxtasksperchild = None,
+                 merge_batchers = False,
+                 chunksize = None,
+                 start_method = None,
+                 preimport = (),
+                 shared_memory_threshold = None):
         """Initializes a new instance of the
         MultiprocessingParallelizationBackend.
 
-        Args: The same as the multiprocessing.Pool class
+        The processing pool is created when jobs are first started, with the
+        persistent cache installed on each worker, and is recreated whenever
+        jobs are started with a different persistent cache.
+
+        Args: The same as the multiprocessing.Pool class, plus:
+            merge_batchers: Whether or not to merge calls with the same
+                batcher and function across job specifications, so that each
+                batcher is invoked with the calls from all keys at once
+                (split across workers).  This allows batchers which evaluate
+                calls together (e.g. numpy_batcher) to work with larger
+                batches, but means that calls with different keys may be
+                evaluated by the same job (defaults to False).
+            chunksize: The number of jobs to send to a worker at once, or
+                None to aim for four chunks per worker (defaults to None)
+            start_method: The multiprocessing start method to use for
+                workers, or None to use the platform default (defaults to
+                None).  Workers started with 'fork' inherit imported modules
+                and the persistent cache rather than re-importing and
+                unpickling them, but forking isn't safe on all platforms.
+            preimport: An iterable of names of modules (e.g. those providing
+                batchers and parallelized functions) to import on each worker
+                when it starts (defaults to ())
+            shared_memory_threshold: The minimum size (in bytes) of NumPy
+                array arguments which should be sent to workers by copying
+                them into shared memory, rather than by pickling them with the
+                job, or None to never use shared memory.  Arrays in shared
+                memory are read-only on workers, and each array holds a file
+                descriptor open until its jobs complete, so submitting many
+                such arrays at once may require raising the open file limit
+                (e.g. with ulimit -n).  Requires Python 3.8 or later
+                (defaults to None)
         """
-        # Create the processing pool
-        self._cluster = Pool(*args, **kwargs)
+        # Store pool parameters, using the same default pool size as Pool
+        self._processes = processes or os.cpu_count() or 1
+        self._initializer = initializer
+        self._initargs = initargs
+        self._maxtasksperchild = maxtasksperchild
+        self._preimport = tuple(preimport)
+
+        # Create the multiprocessing context
+        self._context = get_context(start_method)
+
+        # Store job merging behavior
+        self._merge_batchers = merge_batchers
+
+        # Store submission chunk size
+        self._chunksize = chunksize
+
+        # Store the shared memory threshold
+        self._shared_memory_threshold = shared_memory_threshold
+
+        # Create pool state.  The pool is tagged with the persistent cache
+        # installed on its workers and, if the cache could be pickled, the
+        # digest of its pickled form.  The pool lock is separate from the job
+        # tracking lock, since shutting down the pool waits for its completion
+        # watcher to exit, and the watcher takes the latter.
+        self._pool_lock = threading.Lock()
+        self._cluster = None
+        self._completion_queue = None
+        self._watcher = None
+        self._cluster_cache = None
+        self._cluster_cache_digest = None
+
+        # Create job tracking state, which is shared with the completion
+        # watcher thread.  Pending job ids map to the JobSets and notification
+        # callbacks of the submissions they belong to, and the exceptions
+        # raised by failed jobs are stored (by the JobSet of their submission,
+        # so that they are discarded along with it) until they are re-raised.
+        # Job ids only need to be unique to this backend, so they're drawn
+        # from a counter.
+        self._lock = threading.Lock()
+        self._next_id = count()
+        self._pending = {}
+        self._errors = WeakKeyDictionary()
+
+        # Create shared memory tracking state, which is also shared with the
+        # completion watcher thread.  Shared memory block names map to lists
+        # of the form [shared_memory, reference_count], where the count is the
+        # number of pending jobs referring to the block, and the ids of those
+        # jobs map to the names of the blocks they refer to.
+        self._shared_memory = {}
+        self._job_shared_memory = {}
+
+    @property
+    def worker_count(self):
+        """The number of processes in the pool.
+        """
+        return self._processes
+
+    def _pool(self, cache):
+        """Returns a processing pool whose workers have a persistent cache
+        installed, creating it if necessary.
+
+        Args:
+            cache: The persistent cache which should be installed on workers
+
+        Returns:
+            The processing pool.
+        """
+        # Reuse the existing pool if it has the same cache, otherwise replace
+        # it.  A different cache is only used on a new run, by which time any
+        # jobs on the existing pool have completed.
+        with self._pool_lock:
+            # If the pool was created with this cache, then use it
+            if self._cluster is not None and self._cluster_cache is cache:
+                return self._cluster
+
+            # Pickle the cache, and use the existing pool if its cache has the
+            # same pickled form (e.g. when a new cache object is created with
+            # the same path for each run).  Forked workers inherit the cache
+            # object from this process rather than being sent it, so under
+            # fork the cache needn't be picklable, in which case it can only
+            # be identified by identity.
+            fork = self._context.get_start_method() == 'fork'
+            try:
+                cache_data = dumps(cache, HIGHEST_PROTOCOL)
+            except Exception:
+                if not fork:
+                    raise
+                cache_data = cache_digest = None
+            else:
+                cache_digest = sha1(cache_data).digest()
+                if self._cluster is not None \
+                        and self._cluster_cache_digest == cache_digest:
+                    self._cluster_cache = cache
+                    return self._cluster
+            cache_id = cache_digest or id(cache)
+
+            # Replace the pool, and its completion queue and watcher.  The
+            # watcher is started after the pool, so that workers aren't forked
+            # while it is running.
+            self._shutdown(False)
+            self._completion_queue = self._context.SimpleQueue()
+            self._cluster = self._context.Pool(
+                self._processes,
+                _initialize,
+                (self._completion_queue,
+                 cache_id,
+                 None if fork else cache_data,
+                 cache if fork else None,
+                 self._preimport,
+                 self._initializer,
+                 self._initargs),
+                self._maxtasksperchild
+            )
+            self._watcher = threading.Thread(target = self._watch,
+                                             args = (self._completion_queue,))
+            self._watcher.daemon = True
+            self._watcher.start()
+            self._cluster_cache = cache
+            self._cluster_cache_digest = cache_digest
+            return self._cluster
+
+    def _shutdown(self, terminate):
+        """Shuts down the processing pool and its completion watcher, if any.
+
+        The pool lock must be held by the caller.
+
+        Args:
+            terminate: Whether to stop workers immediately, rather than
+                waiting for outstanding jobs to complete
+        """
+        # Check if there's anything to shut down
+        if self._cluster is None:
+            return
+
+        # Stop the pool and wait for its workers to exit
+        if terminate:
+            self._cluster.terminate()
+        else:
+            self._cluster.close()
+        self._cluster.join()
+
+        # Stop the watcher and wait for it to exit
+        self._completion_queue.put(None)
+        self._watcher.join()
+
+        # If workers were terminated, their jobs will never complete, so
+        # release any shared memory that they refer to
+        if terminate:
+            with self._lock:
+                released = [m for m, _ in self._shared_memory.values()]
+                self._shared_memory.clear()
+                self._job_shared_memory.clear()
+            _release_shared_memory(released)
+
+        # Reset pool state
+        self._cluster = None
+        self._completion_queue = None
+        self._watcher = None
+        self._cluster_cache = None
+        self._cluster_cache_digest = None
+
+    def close(self):
+        """Closes the processing pool, waiting for outstanding jobs to
+        complete.
+
+        A new pool will be created if jobs are started again.
+        """
+        with self._pool_lock:
+            self._shutdown(False)
+
+    def terminate(self):
+        """Terminates the processing pool without waiting for outstanding
+        jobs to complete.
+
+        A new pool will be created if jobs are started again.
+        """
+        with self._pool_lock:
+            self._shutdown(True)
+
+    def __enter__(self):
+        """Enters a context which closes the processing pool on exit.
+
+        Returns:
+            The backend.
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Closes the processing pool.
+        """
+        self.close()
+
+    def _watch(self, completion_queue):
+        """Records job completions as they are reported by workers, until a
+        None sentinel is received.
+
+        Completions which arrive together are recorded together, with a
+        single notification per submission, and notifications are sent from
+        this thread rather than the pool's result handling thread, so they
+        can't hold up the delivery of other results.
+
+        Args:
+            completion_queue: The queue of (job_id, error, traceback) tuples
+                on which workers report completions, where error is the
+                exception raised by the job (or None if it succeeded) and
+                traceback is its formatted traceback
+        """
+        while True:
+            # Wait for the next completion, and grab any others which are
+            # already available
+            completed = [completion_queue.get()]
+            while not completion_queue.empty():
+                completed.append(completion_queue.get())
+
+            # Record the completions, and find shared memory blocks which are
+            # no longer referred to by any pending jobs
+            callbacks = set()
+            released = []
+            with self._lock:
+                for completion in completed:
+                    if completion is None:
+                        continue
+                    job_id, error, traceback = completion
+                    jobs, callback = self._pending.pop(job_id)
+                    if error is not None:
+                        # Attach the worker's traceback in the same way as
+                        # Pool does for the exceptions it re-raises
+                        error.__cause__ = RemoteTraceback(
+                            '\n"""\n{0}"""'.format(traceback)
+                        )
+                        self._errors.setdefault(jobs, {})[job_id] = error
+                    jobs.complete(job_id)
+                    callbacks.add(callback)
+                    if self._job_shared_memory:
+                        for name in self._job_shared_memory.pop(job_id, ()):
+                            entry = self._shared_memory[name]
+                            entry[1] -= 1
+                            if entry[1] == 0:
+                                del self._shared_memory[name]
+                                released.append(entry[0])
+
+            # Release shared memory
+            _release_shared_memory(released)
+
+            # Send notifications
+            for callback in callbacks:
+                callback()
+
+            # If we've been told to stop, then we're done
+            if None in completed:
+                return
+
+    def _raise_errors(self, jobs, job_ids):
+        """Re-raises an exception raised by any of the specified jobs.
+
+        Args:
+            jobs: The JobSet of the submission to which the jobs belong
+            job_ids: The ids of the jobs to check
+        """
+        with self._lock:
+            # Most jobs succeed, so avoid checking each job if none failed
+            errors = self._errors.get(jobs)
+            if not errors:
+                return
+            for job_id in job_ids:
+                if job_id in errors:
+                    raise errors.pop(job_id)
 
     def start(self, cache, job_specs, callback):
         """Run jobs on the backend, blocking until their completion.
@@ -50,31 +612,78 @@ class MultiprocessingParallelizationBackend(ParallelizationBackend):
                 owls_parallel.backends.ParallelizationBackend)
             callback: The job notification callback
         """
-        return [self._cluster.apply_async(_run,
-                                          (cache, j),
-                                          callback = lambda x: callback())
-                for j
-                in itervalues(job_specs)]
+        # Grab the processing pool
+        pool = self._pool(cache)
+
+        # Flatten jobs, merging them by batcher if requested
+        if self._merge_batchers:
+            flattened = _merge_specs(job_specs, self._processes)
+        else:
+            flattened = [_flatten_spec(j) for j in job_specs.values()]
+
+        # Copy large array arguments into shared memory if requested, and
+        # pickle jobs up front, rather than leaving it to the pool's task
+        # handling thread, so that jobs which can't be pickled fail here
+        # instead of silently never reporting their completion.  If either
+        # step fails, then any shared memory which was created is released.
+        shared = {}
+        try:
+            if self._shared_memory_threshold is not None:
+                threshold = self._shared_memory_threshold
+                flattened = [_share_arrays(j, threshold, shared)
+                             for j in flattened]
+            else:
+                flattened = [(j, ()) for j in flattened]
+            flattened = [(dumps(j, HIGHEST_PROTOCOL), names)
+                         for j, names in flattened]
+        except Exception:
+            _release_shared_memory(m for _, m in shared.values())
+            raise
+        memories = dict((r.name, m) for r, m in shared.values())
+
+        # Assign ids to jobs and register them (and any shared memory they
+        # refer to) for completion tracking
+        results = JobSet()
+        jobs = []
+        with self._lock:
+            for j, names in flattened:
+                job_id = next(self._next_id)
+                results.add(job_id)
+                self._pending[job_id] = (results, callback)
+                if names:
+                    self._job_shared_memory[job_id] = names
+                    for name in names:
+                        self._shared_memory.setdefault(
+                            name,
+                            [memories[name], 0]
+                        )[1] += 1
+                jobs.append((job_id, j, bool(names)))
+
+        # Submit jobs in chunks, aiming for a few chunks per worker unless a
+        # chunk size was specified.  Their completions are reported on the
+        # completion queue, so the results of the map itself (which are all
+        # None) aren't needed.
+        if jobs:
+            chunk_size = self._chunksize \
+                or max(1, len(jobs) // (4 * self._processes))
+            pool.imap_unordered(_run, jobs, chunk_size)
+
+        # All done
+        return results
 
     def prune(self, jobs):
         """Prunes a collection of jobs by pruning those which are complete.
 
-        The input collection should not be modified.
+        The collection is pruned in place.
 
         Args:
-            jobs: A collection of jobs to prune
+            jobs: The JobSet to prune
 
         Returns:
-            A new collection of jobs which are still incomplete.
+            The JobSet.
         """
-        # Extract unfinished jobs, and re-raise any remote exceptions
-        result = []
-        for j in jobs:
-            if j.ready():
-                # This will re-raise remotely-raised exceptions locally
-                j.get()
-            else:
-                result.append(j)
+        # Remove completed jobs, re-raising any remote exceptions locally
+        self._raise_errors(jobs, jobs.drain())
 
         # All done
-        return result
+        return jobs
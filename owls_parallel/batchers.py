@@ -0,0 +1,125 @@
+"""Provides batchers which can be used with the @parallelized decorator.
+"""
+
+
+# System imports
+import threading
+from functools import wraps
+
+
+# Create a thread-local variable to track the batch currently being evaluated
+# by numpy_batcher in each thread
+_thread_local = threading.local()
+
+
+# Sentinel marking a batch whose calls can't be evaluated in vectorized form
+_UNVECTORIZABLE = object()
+
+
+class _Batch(object):
+    """Tracks the state of a batch being evaluated by numpy_batcher.
+    """
+
+    def __init__(self, calls):
+        """Creates a new batch.
+
+        Args:
+            calls: The list of (args, kwargs) tuples in the batch
+        """
+        self.calls = calls
+        self.index = None
+        self.owner = None
+        self.results = None
+
+
+def numpy_batcher(function, args_kwargs):
+    """A batcher which evaluates all calls in a batch with a single vectorized
+    invocation of the underlying computation.
+
+    The innermost function underneath the @parallelized function must be
+    decorated with @numpy_vectorized.  Each call is still made through the
+    full decorator stack (so that results are stored in the persistent cache),
+    but the first call which reaches the @numpy_vectorized function evaluates
+    the whole batch at once by stacking each positional argument across calls
+    along a new first axis, and all calls then return their element of the
+    result.  Calls whose results are already cached never reach the
+    vectorized function, but are still included in the vectorized evaluation.
+
+    If any call in the batch uses keyword arguments, or if calls have
+    differing numbers of positional arguments, calls are evaluated
+    individually.
+
+    Args:
+        function: The function to call
+        args_kwargs: An iterable of (args, kwargs) tuples
+    """
+    # Create the batch and make it active for this thread
+    batch = _Batch(list(args_kwargs))
+    previous = getattr(_thread_local, 'batch', None)
+    _thread_local.batch = batch
+
+    # Make each call, letting the vectorized function pick up the batch
+    try:
+        for index, (args, kwargs) in enumerate(batch.calls):
+            batch.index = index
+            function(*args, **kwargs)
+    finally:
+        _thread_local.batch = previous
+
+
+def numpy_vectorized(f):
+    """Decorator to allow a NumPy-vectorized function to be evaluated for an
+    entire batch at once by numpy_batcher.
+
+    The function must accept arrays whose first axis indexes independent calls
+    in place of each of its arguments, and return an array (or sequence)
+    whose first axis indexes the corresponding results.  Outside of
+    numpy_batcher, the function is simply called with its arguments.
+
+    This decorator must be the innermost decorator used on the function.
+
+    Args:
+        f: The function to decorate
+
+    Returns:
+        A version of the function which supports batched evaluation.
+    """
+    # Create the wrapper function
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        # If there's no batch being evaluated, or it belongs to another
+        # vectorized function, then just call the function
+        batch = getattr(_thread_local, 'batch', None)
+        if batch is None or batch.owner not in (None, wrapper):
+            return f(*args, **kwargs)
+
+        # If this is the first call to reach us in this batch, then claim
+        # the batch and evaluate it if possible
+        if batch.owner is None:
+            batch.owner = wrapper
+            calls = batch.calls
+            arity = len(calls[0][0])
+            if any(kw or len(a) != arity for a, kw in calls):
+                batch.results = _UNVECTORIZABLE
+            else:
+                # Import NumPy lazily, since it's an optional dependency
+                import numpy
+                batch.results = f(*[numpy.stack([numpy.asarray(a[i])
+                                                 for a, _ in calls])
+                                    for i in range(arity)])
+
+        # If the batch can't be vectorized, or if this isn't the call being
+        # made by the batcher (e.g. it's a nested call made by a function in
+        # the decorator stack), then just call the function
+        if batch.results is _UNVECTORIZABLE \
+                or kwargs \
+                or len(args) != len(batch.calls[batch.index][0]) \
+                or any(a is not b
+                       for a, b in zip(args, batch.calls[batch.index][0])):
+            return f(*args, **kwargs)
+
+        # Otherwise return our element of the result
+        return batch.results[batch.index]
+
+    # Return the wrapper
+    return wrapper
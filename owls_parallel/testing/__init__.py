@@ -5,12 +5,16 @@ name on the backend.
 """
 
 
+# System imports
+import threading
+
 # owls-cache imports
 from owls_cache.persistent import cached as persistently_cached
 from owls_cache.persistent.caches.fs import FileSystemPersistentCache
 
 # owls-parallel imports
 from owls_parallel import parallelized
+from owls_parallel.batchers import numpy_batcher, numpy_vectorized
 
 
 # Global counter which records the number of times the computation is called
@@ -39,3 +43,130 @@ def computation(a, b):
 
     # Return the result
     return a + b
+
+
+@parallelized(fused = lambda a, b: ((a,), 0))
+@persistently_cached('owls_parallel.testing.fused_computation',
+                     lambda a, b: (a, b))
+def fused_computation(a, b):
+    """Test computation which is persistently-cached and parallelized using a
+    fused mapper/mocker.  It multiplies two numbers.
+
+    Args:
+        a: The first number
+        b: The second number
+
+    Returns:
+        The product of a and b.
+    """
+    # Increment the counter
+    counter.value += 1
+
+    # Return the result
+    return a * b
+
+
+@parallelized(lambda a, b: 0, lambda a, b: (a,), numpy_batcher)
+@persistently_cached('owls_parallel.testing.vectorized_computation',
+                     lambda a, b: (a, b))
+@numpy_vectorized
+def vectorized_computation(a, b):
+    """Test computation which is persistently-cached, parallelized, and
+    evaluated in vectorized batches.  It subtracts two numbers (or arrays of
+    numbers).
+
+    Args:
+        a: The first number
+        b: The second number
+
+    Returns:
+        The difference of a and b.
+    """
+    # Increment the counter
+    counter.value += 1
+
+    # Return the result
+    return a - b
+
+
+@parallelized(lambda key, b: 0, lambda key, b: key)
+@persistently_cached('owls_parallel.testing.keyed_computation',
+                     lambda key, b: (key, b))
+def keyed_computation(key, b):
+    """Test computation which is persistently-cached and parallelized, and
+    whose calls are grouped using its first argument directly as the key.  It
+    doubles its second argument.
+
+    Args:
+        key: The grouping key
+        b: The number to double
+
+    Returns:
+        Twice b.
+    """
+    # Increment the counter
+    counter.value += 1
+
+    # Return the result
+    return 2 * b
+
+
+@parallelized(lambda a, b: 0, lambda a, b: (a,))
+@persistently_cached('owls_parallel.testing.failing_computation',
+                     lambda a, b: (a, b))
+def failing_computation(a, b):
+    """Test computation which is persistently-cached and parallelized, but
+    which always fails.
+
+    Args:
+        a: The value to report
+        b: Unused
+
+    Raises:
+        ValueError: Always.
+    """
+    raise ValueError('bad value {0}'.format(a))
+
+
+@parallelized(lambda a, b: 0, lambda a, b: (a,))
+@persistently_cached('owls_parallel.testing.other_failing_computation',
+                     lambda a, b: (a, b))
+def other_failing_computation(a, b):
+    """Test computation which is persistently-cached and parallelized, but
+    which always fails, with a different exception than failing_computation.
+
+    Args:
+        a: The value to report
+        b: Unused
+
+    Raises:
+        KeyError: Always.
+    """
+    raise KeyError(a)
+
+
+class UnpicklableError(Exception):
+    """An exception which can't be pickled.
+    """
+
+    def __init__(self):
+        """Creates a new instance of the UnpicklableError class.
+        """
+        super(UnpicklableError, self).__init__(threading.Lock())
+
+
+@parallelized(lambda a, b: 0, lambda a, b: (a,))
+@persistently_cached('owls_parallel.testing.unpicklable_failing_computation',
+                     lambda a, b: (a, b))
+def unpicklable_failing_computation(a, b):
+    """Test computation which is persistently-cached and parallelized, but
+    which always fails with an exception that can't be pickled.
+
+    Args:
+        a: Unused
+        b: Unused
+
+    Raises:
+        UnpicklableError: Always.
+    """
+    raise UnpicklableError()
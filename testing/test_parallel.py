@@ -1,8 +1,13 @@
 # System imports
+import io
+import os
+import sys
+import threading
 import unittest
-from subprocess import check_output
-from os.path import abspath
+from subprocess import check_call, check_output
+from os.path import abspath, dirname, join
 from uuid import uuid4
+from contextlib import redirect_stdout
 from os import makedirs
 from shutil import rmtree
 
@@ -11,12 +16,42 @@ from owls_cache.persistent import caching_into
 from owls_cache.persistent.caches.fs import FileSystemPersistentCache
 
 # owls-parallel imports
-from owls_parallel import parallelized, ParallelizedEnvironment
+from owls_parallel import parallelized, ParallelizedEnvironment, _batcher
+from owls_parallel.backends import ParallelizationBackend, \
+    AggregateBatcherError
 from owls_parallel.backends.multiprocessing import \
     MultiprocessingParallelizationBackend
+from owls_parallel.backends.ipython import _TaskPacker
 from owls_parallel.backends.batch import BatchParallelizationBackend, \
-    qsub_submit, qsub_monitor
-from owls_parallel.testing import counter, computation
+    qsub_submit, qsub_monitor, _qstat_completed, _qstat_sequence_number, \
+    _capture_output
+from owls_parallel.batchers import numpy_batcher, numpy_vectorized
+from owls_parallel.testing import counter, computation, \
+    fused_computation, vectorized_computation, keyed_computation, \
+    failing_computation, other_failing_computation, \
+    unpicklable_failing_computation
+
+
+# Create a multiprocessing backend to share between tests, and close it once
+# all tests have run.  Each test uses its own persistent cache, so the pool is
+# recreated for each test, but it is reused across the runs within a test.
+multiprocessing_backend = MultiprocessingParallelizationBackend(
+    2,
+    preimport = ('owls_parallel.testing',)
+)
+
+
+def tearDownModule():
+    multiprocessing_backend.close()
+
+
+# Check if NumPy is available for vectorized batching
+numpy_available = False
+try:
+    import numpy
+    numpy_available = True
+except ImportError:
+    pass
 
 
 # Check if IPython support is available, and try to setup a backend for it,
@@ -29,6 +64,11 @@ except:
     pass
 
 
+# The root of the source tree, which is added to the module search path of
+# batch scripts run locally
+source_root = dirname(dirname(abspath(__file__)))
+
+
 # Check if batch parallelization is available (the backend will be created
 # later once the working directory is known)
 batch_available = False
@@ -85,6 +125,289 @@ class TestParallelizationBase(unittest.TestCase):
         self.assertEqual(counter.value, 4 if is_null else 1)
 
 
+class RecordingParallelizationBackend(ParallelizationBackend):
+    """A backend which records the job specifications it is given without
+    running them.
+    """
+
+    def __init__(self):
+        self.job_specs = []
+
+    def start(self, cache, job_specs, callback):
+        self.job_specs.append(job_specs)
+        return []
+
+    def prune(self, jobs):
+        return jobs
+
+
+class ParallelRecordingParallelizationBackend(
+        RecordingParallelizationBackend
+):
+    """A backend which records the job specifications it is given, allowing
+    concurrent submission, and whose jobs (one per key) complete immediately.
+    """
+
+    parallel_submit = True
+
+    def __init__(self):
+        super(ParallelRecordingParallelizationBackend, self).__init__()
+        self._lock = threading.Lock()
+
+    def start(self, cache, job_specs, callback):
+        with self._lock:
+            self.job_specs.append(job_specs)
+        return list(job_specs)
+
+    def prune(self, jobs):
+        return []
+
+
+class IncrementalParallelizationBackend(ParallelizationBackend):
+    """A backend which reports the completion of its jobs (one per key) via
+    completed_since, one job per query, without running them.
+    """
+
+    def __init__(self):
+        self.job_specs = []
+        self._jobs = []
+
+    def start(self, cache, job_specs, callback):
+        self.job_specs.append(job_specs)
+        jobs = list(job_specs)
+        self._jobs.extend(jobs)
+        return jobs
+
+    def prune(self, jobs):
+        raise AssertionError('completed_since should be used instead')
+
+    def completed_since(self, token):
+        index = token or 0
+        return self._jobs[index:index + 1], index + 1
+
+
+class PeekableCache(FileSystemPersistentCache):
+    """A persistent cache which reports a fixed set of values as cached via
+    peek.
+    """
+
+    def __init__(self, path, values):
+        super(PeekableCache, self).__init__(path)
+        self.values = values
+
+    def peek(self, key):
+        if key in self.values:
+            return True, self.values[key]
+        return False, None
+
+
+# A parallelized computation which exposes the key under which its results
+# are cached, so that cached results can be found by peeking during capture
+def _peekable_computation(a, b):
+    return a + b
+
+
+_peekable_computation._cache_key = lambda a, b: (a, b)
+peekable_computation = parallelized(lambda a, b: 0,
+                                    lambda a, b: (a,))(_peekable_computation)
+
+
+class TestCapture(TestParallelizationBase):
+    def capture(self, function, backend = None, cache = None, **kwargs):
+        # Create a parallelization environment which records job
+        # specifications
+        if backend is None:
+            backend = RecordingParallelizationBackend()
+        parallel = ParallelizedEnvironment(backend, 5, **kwargs)
+
+        # Run the capture pass and submit the captured calls, without running
+        # them locally afterwards, and recording progress output
+        if cache is None:
+            cache = FileSystemPersistentCache(self.working_directory)
+        output = io.StringIO()
+        with caching_into(cache):
+            with redirect_stdout(output):
+                self.assertTrue(parallel.run())
+                function()
+                self.assertTrue(parallel.run())
+        self.output = output.getvalue()
+
+        # If submission was concurrent, then return the groups of submitted
+        # job specifications
+        if backend.parallel_submit:
+            return backend.job_specs
+
+        # Return the submitted job specifications
+        self.assertEqual(len(backend.job_specs), 1)
+        return backend.job_specs[0]
+
+    def test_deduplication(self):
+        # Capture repeated calls, some of which have unhashable arguments
+        def function():
+            computation(1, 2)
+            computation(1, 2)
+            computation(1, [3])
+            computation(1, [3])
+        job_specs = self.capture(function)
+
+        # Make sure that repeated calls with hashable arguments were only
+        # recorded once, and that the others were all recorded
+        self.assertEqual(list(job_specs[(1,)][_batcher][computation]),
+                         [((1, 2), {}), ((1, [3]), {}), ((1, [3]), {})])
+
+    def test_ordering(self):
+        # Capture calls of different functions, interleaved, in two different
+        # orders
+        def forward():
+            for a in (3, 1, 2):
+                computation(a, 0)
+                fused_computation(a + 10, 0)
+
+        def backward():
+            for a in (2, 1, 3):
+                fused_computation(a + 10, 0)
+                computation(a, 0)
+        forward_keys = list(self.capture(forward))
+        backward_keys = list(self.capture(backward))
+
+        # Make sure that jobs are ordered independently of capture order, and
+        # that jobs calling the same function are contiguous
+        self.assertEqual(forward_keys, backward_keys)
+        self.assertEqual(set(forward_keys[:3]), set([(1,), (2,), (3,)]))
+        self.assertEqual(set(forward_keys[3:]), set([(11,), (12,), (13,)]))
+
+    def test_peek(self):
+        # Capture calls, some of which are already cached, with a cache that
+        # can be peeked into
+        results = []
+
+        def function():
+            results.append(peekable_computation(1, 2))
+            results.append(peekable_computation(3, 4))
+        cache = PeekableCache(self.working_directory, {(1, 2): 3})
+        job_specs = self.capture(function, cache = cache)
+
+        # Make sure that the cached call returned its real value and wasn't
+        # recorded, while the other call returned a dummy value and was
+        # recorded
+        self.assertEqual(results, [3, 0])
+        self.assertEqual(list(job_specs), [(3,)])
+
+    def test_parallel_submit(self):
+        # Capture calls with many keys, both with a backend which submits
+        # serially and with one which allows concurrent submission
+        def function():
+            for a in range(10):
+                computation(a, 0)
+        keys = list(self.capture(function))
+        groups = self.capture(function,
+                              ParallelRecordingParallelizationBackend(),
+                              submit_concurrency = 3)
+
+        # Make sure that jobs were submitted concurrently in contiguous
+        # groups, with each key submitted exactly once
+        self.assertEqual(len(groups), 3)
+        groups.sort(key = lambda g: keys.index(next(iter(g))))
+        self.assertEqual([k for g in groups for k in g], keys)
+
+        # Make sure that progress counted the jobs from all groups
+        self.assertIn('(10/10)', self.output)
+
+    def test_completed_since(self):
+        # Capture calls with a few keys using a backend which reports
+        # completions incrementally
+        def function():
+            for a in range(3):
+                computation(a, 0)
+        self.capture(function, IncrementalParallelizationBackend())
+
+        # Make sure that the environment finished, reporting progress as each
+        # job completed
+        for completed in range(1, 4):
+            self.assertIn('({0}/3)'.format(completed), self.output)
+
+
+@unittest.skipIf(not numpy_available, 'NumPy not available')
+class TestNumpyBatcher(unittest.TestCase):
+    def setUp(self):
+        # Create a vectorized function which records its invocations
+        self.invocations = []
+
+        @numpy_vectorized
+        def subtract(a, b):
+            self.invocations.append((a, b))
+            return a - b
+
+        # Create a function which calls it and records the results
+        self.results = []
+
+        def function(*args, **kwargs):
+            self.results.append(subtract(*args, **kwargs))
+        self.function = function
+
+    def test_vectorized(self):
+        # Make sure that the whole batch is evaluated with a single call
+        numpy_batcher(self.function, [((5, 3), {}), ((5, 7), {})])
+        self.assertEqual(len(self.invocations), 1)
+        self.assertEqual(self.results, [2, -2])
+
+    def test_unvectorizable(self):
+        # Make sure that calls with keyword arguments are evaluated
+        # individually
+        numpy_batcher(self.function, [((5,), {'b': 3}), ((5,), {'b': 7})])
+        self.assertEqual(len(self.invocations), 2)
+        self.assertEqual(self.results, [2, -2])
+
+
+class TestQstat(unittest.TestCase):
+    # Sample output of qstat -t, with array tasks listed individually
+    output = '\n'.join((
+        'Job ID            Name          User   Time Use S Queue',
+        '----------------- ------------- ------ -------- - -----',
+        '123[1].server     script.py-1   user   00:00:05 C batch',
+        '123[2].server     script.py-2   user   00:00:01 R batch',
+        '123[3].server     script.py-3   user          0 Q batch',
+        '124.server        other.py      user   00:01:00 R batch',
+        ''
+    ))
+
+    def test_sequence_number(self):
+        self.assertEqual(_qstat_sequence_number('123[1].server'), '123[1]')
+        self.assertEqual(_qstat_sequence_number('124.server.domain'), '124')
+
+    def test_completed(self):
+        # Make sure that only jobs listed as complete, or not listed at all,
+        # are reported as complete
+        job_ids = ['123[1].server', '123[2].server', '123[3].server',
+                   '124.server', '125.server']
+        self.assertEqual(_qstat_completed(job_ids, self.output),
+                         set(['123[1].server', '125.server']))
+
+
+class TestCaptureOutput(unittest.TestCase):
+    def test_output(self):
+        # Make sure that both output streams are captured and that a non-0
+        # exit status is ignored
+        output = _capture_output(
+            ['sh', '-c', 'echo out; echo err >&2; exit 3']
+        )
+        self.assertEqual(sorted(output.splitlines()), [b'err', b'out'])
+
+    def test_missing_command(self):
+        # Find the lowest available file descriptor, which will be different
+        # afterward if any descriptors are leaked
+        def lowest_available_fd():
+            fd = os.dup(0)
+            os.close(fd)
+            return fd
+        fd = lowest_available_fd()
+
+        # Make sure that a missing command raises without leaking descriptors
+        with self.assertRaises(OSError):
+            _capture_output(['owls-parallel-missing-command'])
+        self.assertEqual(lowest_available_fd(), fd)
+
+
 class TestNullParallelization(TestParallelizationBase):
     def setUp(self):
         # Call superclass setup
@@ -103,11 +426,240 @@ class TestMultiprocessingParallelization(TestParallelizationBase):
         super(TestMultiprocessingParallelization, self).setUp()
 
         # Set the backend
-        self._backend = MultiprocessingParallelizationBackend(2)
+        self._backend = multiprocessing_backend
 
     def test(self):
         self.execute()
 
+    def test_error(self):
+        # Make sure that an exception raised by a job is re-raised locally,
+        # along with the traceback from the worker
+        parallel = ParallelizedEnvironment(self._backend, 5)
+        with caching_into(FileSystemPersistentCache(self.working_directory)):
+            with self.assertRaises(ValueError) as context:
+                while parallel.run(False):
+                    failing_computation(3, 0)
+        self.assertEqual(str(context.exception), 'bad value 3')
+        self.assertIn('failing_computation', str(context.exception.__cause__))
+
+    def test_aggregate_error(self):
+        # Make sure that when several batcher invocations in a job fail, they
+        # all run and their exceptions are re-raised together
+        parallel = ParallelizedEnvironment(self._backend, 5)
+        with caching_into(FileSystemPersistentCache(self.working_directory)):
+            with self.assertRaises(AggregateBatcherError) as context:
+                while parallel.run(False):
+                    failing_computation(3, 0)
+                    other_failing_computation(3, 0)
+        errors = context.exception.errors
+        self.assertEqual(
+            sorted((f.__name__, type(e)) for f, e in errors),
+            [('failing_computation', ValueError),
+             ('other_failing_computation', KeyError)]
+        )
+
+    def test_unpicklable_error(self):
+        # Make sure that an exception which can't be sent back from the
+        # worker is still reported
+        parallel = ParallelizedEnvironment(self._backend, 5)
+        with caching_into(FileSystemPersistentCache(self.working_directory)):
+            with self.assertRaises(RuntimeError) as context:
+                while parallel.run(False):
+                    unpicklable_failing_computation(3, 0)
+        self.assertIn('UnpicklableError', str(context.exception))
+
+    def test_pool_reuse(self):
+        # Make sure that the pool is reused for an equivalent cache, but not
+        # for a different one
+        pool = self._backend._pool(
+            FileSystemPersistentCache(self.working_directory)
+        )
+        self.assertIs(self._backend._pool(
+            FileSystemPersistentCache(self.working_directory)
+        ), pool)
+        other_directory = join(self.working_directory, 'other')
+        makedirs(other_directory)
+        self.assertIsNot(self._backend._pool(
+            FileSystemPersistentCache(other_directory)
+        ), pool)
+
+    def test_split(self):
+        # Reset the counter
+        counter.value = 0
+
+        # Create a parallelization environment with the current backend
+        parallel = ParallelizedEnvironment(self._backend, 5)
+
+        # Run enough computations with the same key that they'll be split
+        # across multiple jobs
+        with caching_into(FileSystemPersistentCache(self.working_directory)):
+            while parallel.run(False):
+                results = [computation(1, b) for b in range(100)]
+
+        # Make sure the computation was never invoked locally and validate the
+        # results
+        self.assertEqual(counter.value, 0)
+        self.assertEqual(results, [1 + b for b in range(100)])
+
+    def test_split_keys(self):
+        # Reset the counter
+        counter.value = 0
+
+        # Create a parallelization environment with the current backend
+        parallel = ParallelizedEnvironment(self._backend, 5)
+
+        # Run enough computations with one key that they'll be split across
+        # multiple jobs, along with computations using a key which looks like
+        # the key of one of those jobs
+        with caching_into(FileSystemPersistentCache(self.working_directory)):
+            while parallel.run(False):
+                split = [keyed_computation('a', b) for b in range(100)]
+                other = [keyed_computation(('a', 0), b) for b in range(5)]
+
+        # Make sure the computation was never invoked locally and validate the
+        # results
+        self.assertEqual(counter.value, 0)
+        self.assertEqual(split, [2 * b for b in range(100)])
+        self.assertEqual(other, [2 * b for b in range(5)])
+
+    def test_fused(self):
+        # Reset the counter
+        counter.value = 0
+
+        # Create a parallelization environment with the current backend
+        parallel = ParallelizedEnvironment(self._backend, 5)
+
+        # Run computations using a fused mapper/mocker
+        loop_count = 0
+        with caching_into(FileSystemPersistentCache(self.working_directory)):
+            while parallel.run(False):
+                x = fused_computation(2, 3)
+                y = fused_computation(4, 5)
+
+                # Check that dummy values are returned while capturing
+                if loop_count == 0:
+                    self.assertEqual((x, y), (0, 0))
+                loop_count += 1
+
+        # Make sure the computation was never invoked locally and validate the
+        # results
+        self.assertEqual(counter.value, 0)
+        self.assertEqual(x, 6)
+        self.assertEqual(y, 20)
+
+    def test_merged(self):
+        # Reset the counter
+        counter.value = 0
+
+        # Create a parallelization environment with a backend which merges
+        # calls across keys
+        with MultiprocessingParallelizationBackend(2,
+                                                   merge_batchers = True) \
+                as backend:
+            parallel = ParallelizedEnvironment(backend, 5)
+
+            # Run computations with many different keys
+            cache = FileSystemPersistentCache(self.working_directory)
+            with caching_into(cache):
+                while parallel.run(False):
+                    results = [computation(a, 1) for a in range(10)]
+
+        # Make sure the computation was never invoked locally and validate the
+        # results
+        self.assertEqual(counter.value, 0)
+        self.assertEqual(results, [a + 1 for a in range(10)])
+
+    @unittest.skipIf(not numpy_available, 'NumPy not available')
+    def test_shared_memory(self):
+        # Reset the counter
+        counter.value = 0
+
+        # Create a parallelization environment with a backend which sends
+        # large arrays through shared memory
+        with MultiprocessingParallelizationBackend(
+                2,
+                shared_memory_threshold = 1024
+        ) as backend:
+            parallel = ParallelizedEnvironment(backend, 5)
+
+            # Run computations with large array arguments
+            values = numpy.arange(1000.0)
+            cache = FileSystemPersistentCache(self.working_directory)
+            with caching_into(cache):
+                while parallel.run(False):
+                    results = [computation(a, values) for a in range(3)]
+
+        # Make sure the computation was never invoked locally and validate the
+        # results
+        self.assertEqual(counter.value, 0)
+        for a, result in enumerate(results):
+            self.assertTrue(numpy.array_equal(result, a + values))
+
+    @unittest.skipIf(not numpy_available, 'NumPy not available')
+    def test_vectorized(self):
+        # Reset the counter
+        counter.value = 0
+
+        # Create a parallelization environment with the current backend
+        parallel = ParallelizedEnvironment(self._backend, 5)
+
+        # Run computations which will be batched and vectorized
+        with caching_into(FileSystemPersistentCache(self.working_directory)):
+            while parallel.run(False):
+                x = vectorized_computation(5, 3)
+                y = vectorized_computation(5, 7)
+
+        # Make sure the computation was never invoked locally and validate the
+        # results
+        self.assertEqual(counter.value, 0)
+        self.assertEqual(x, 2)
+        self.assertEqual(y, -2)
+
+
+class TestTaskPacker(unittest.TestCase):
+    def setUp(self):
+        # Create a packer, and a function to create jobs which make a given
+        # number of calls to a single function
+        self.packer = _TaskPacker(1.0)
+        self.key = ('batcher', 'function')
+
+        def job(calls):
+            return [self.key + ([((), {})] * calls,)]
+        self.job = job
+
+    def test_estimate_cost(self):
+        # Make sure that calls of unobserved functions have the default cost
+        default_cost = self.packer.estimate_cost(self.job(1))
+        self.assertGreater(default_cost, 0)
+        self.assertEqual(self.packer.estimate_cost(self.job(3)),
+                         3 * default_cost)
+
+        # Make sure that the first observation sets the cost of calls, and
+        # that later observations are smoothed
+        self.packer.record_timings([self.key], [(4, 2.0)])
+        self.assertEqual(self.packer.estimate_cost(self.job(2)), 1.0)
+        self.packer.record_timings([self.key], [(1, 1.5)])
+        self.assertAlmostEqual(self.packer.estimate_cost(self.job(1)), 0.8)
+
+    def test_pack(self):
+        # Set the cost of each call
+        self.packer.record_timings([self.key], [(4, 1.0)])
+
+        # Make sure that jobs are packed up to the target cost
+        jobs = [self.job(1) for _ in range(10)]
+        self.assertEqual([len(p) for p in self.packer.pack(jobs, 2)],
+                         [4, 4, 2])
+
+        # Make sure that there are no fewer tasks than workers
+        self.assertEqual([len(p) for p in self.packer.pack(jobs, 5)],
+                         [2, 2, 2, 2, 2])
+
+        # Make sure that expensive jobs aren't packed, and that the order of
+        # jobs is preserved
+        jobs = [self.job(8), self.job(1), self.job(2)]
+        self.assertEqual(self.packer.pack(jobs, 1),
+                         [[jobs[0]], [jobs[1], jobs[2]]])
+
 
 @unittest.skipIf(ipython_backend is None, 'IPython cluster not available')
 class TestIPythonParallelization(TestParallelizationBase):
@@ -122,6 +674,108 @@ class TestIPythonParallelization(TestParallelizationBase):
         self.execute()
 
 
+class TestLocalBatchParallelization(TestParallelizationBase):
+    def setUp(self):
+        # Call superclass setup
+        super(TestLocalBatchParallelization, self).setUp()
+
+        # Track the sizes of submitted array jobs
+        self.submissions = []
+
+        # Set the backend, using submission and monitoring functions which run
+        # batch scripts locally
+        self._backend = BatchParallelizationBackend(
+            join(self.working_directory, 'batch'),
+            self.submit,
+            self.monitor,
+            interval = 0.1,
+            retention = 3600
+        )
+
+    def tearDown(self):
+        # Close the backend
+        self._backend.close()
+
+        # Call superclass teardown
+        super(TestLocalBatchParallelization, self).tearDown()
+
+    def submit(self, working_directory, script_name, array_size):
+        # Record the submission
+        self.submissions.append(array_size)
+
+        # Run each array task to completion, passing its index as an argument
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.pathsep.join(
+            p for p in (source_root, os.environ.get('PYTHONPATH')) if p
+        )
+        for index in range(1, array_size + 1):
+            check_call([sys.executable, script_name, str(index)],
+                       cwd = working_directory,
+                       env = environment)
+
+        # Generate job ids
+        return ['{0}.{1}'.format(script_name, index)
+                for index
+                in range(1, array_size + 1)]
+
+    def monitor(self, job_ids):
+        # Jobs are run to completion when submitted.  Also report a job which
+        # was never submitted, which the backend should ignore.
+        return set(job_ids) | set(['unknown'])
+
+    def test(self):
+        self.execute()
+        self.assertEqual(self.submissions, [3])
+
+    def test_reuse(self):
+        # Start the same job twice
+        cache = FileSystemPersistentCache(self.working_directory)
+        job_specs = {(1,): {_batcher: {computation: [((1, 2), {})]}}}
+        first = self._backend.start(cache, job_specs, lambda: None)
+        second = self._backend.start(cache, job_specs, lambda: None)
+
+        # Make sure the job was only submitted once, and that both starts
+        # refer to the same job
+        self.assertEqual(self.submissions, [1])
+        self.assertEqual(set(first), set(second))
+
+    def test_reuse_completion(self):
+        # Start the same job twice, recording notifications for each start
+        cache = FileSystemPersistentCache(self.working_directory)
+        job_specs = {(1,): {_batcher: {computation: [((1, 2), {})]}}}
+        first_notified = threading.Event()
+        second_notified = threading.Event()
+        first = self._backend.start(cache, job_specs, first_notified.set)
+        second = self._backend.start(cache, job_specs, second_notified.set)
+
+        # Make sure that both starts are notified of the job's completion and
+        # drain
+        self.assertTrue(first_notified.wait(10))
+        self.assertTrue(second_notified.wait(10))
+        self.assertEqual(len(self._backend.prune(first)), 0)
+        self.assertEqual(len(self._backend.prune(second)), 0)
+
+    def test_monitor_error(self):
+        # Create a backend whose monitor fails
+        def monitor(job_ids):
+            raise OSError('monitor failed')
+        self._backend.close()
+        self._backend = BatchParallelizationBackend(
+            join(self.working_directory, 'batch'),
+            self.submit,
+            monitor,
+            interval = 0.1
+        )
+
+        # Make sure the error is raised by the environment rather than leaving
+        # it waiting
+        parallel = ParallelizedEnvironment(self._backend, 5)
+        with caching_into(FileSystemPersistentCache(self.working_directory)):
+            with self.assertRaises(OSError):
+                while parallel.run(False):
+                    computation(1, 2)
+
+
 @unittest.skipIf(not batch_available, 'Batch cluster not available')
 class TestBatchParallelization(TestParallelizationBase):
     def setUp(self):